@@ -0,0 +1,244 @@
+from typing import Dict, Iterable, List
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.evaluation.metrics import (
+    RankedQueries,
+    calculate_ranking_metric_values,
+    get_rankable_query_index,
+)
+
+
+def _safe_divide(numerator: float, denominator: float) -> float:
+    """
+    nan if nothing has been accumulated, like the mean of no values
+    """
+    return numerator / denominator if denominator > 0 else np.nan
+
+
+class MetricAccumulator(ABC):
+    """
+    Build up metrics one chunk of scored data at a time
+    Only keeps a small amount of state, so memory is bounded
+    Accumulators for different chunks can be merged, eg. from workers
+    """
+
+    def __init__(self, schema: Schema, y_pred_col: str):
+        self.schema = schema
+        self.y_pred_col = y_pred_col
+
+    def _get_arrays(self, chunk: pd.DataFrame):
+        y_true = chunk[self.schema.target].to_numpy(dtype=np.float64)
+        y_pred = chunk[self.y_pred_col].to_numpy(dtype=np.float64)
+        return y_true, y_pred
+
+    @abstractmethod
+    def update(self, chunk: pd.DataFrame) -> None:
+        pass
+
+    @abstractmethod
+    def merge(self, other: "MetricAccumulator") -> "MetricAccumulator":
+        pass
+
+    @abstractmethod
+    def result(self) -> Dict[str, float]:
+        pass
+
+
+class LogLossAccumulator(MetricAccumulator):
+    """
+    Exact log loss, predictions are clipped the same way as sklearn
+    """
+
+    def __init__(self, schema: Schema, y_pred_col: str):
+        super().__init__(schema, y_pred_col)
+        self.total_loss = 0.0
+        self.count = 0
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        y_true, y_pred = self._get_arrays(chunk)
+        eps = np.finfo(y_pred.dtype).eps
+        y_pred = np.clip(y_pred, eps, 1 - eps)
+        losses = y_true * np.log(y_pred) + (1 - y_true) * np.log(1 - y_pred)
+        self.total_loss -= losses.sum()
+        self.count += len(y_true)
+
+    def merge(self, other: "LogLossAccumulator") -> "LogLossAccumulator":
+        self.total_loss += other.total_loss
+        self.count += other.count
+        return self
+
+    def result(self) -> Dict[str, float]:
+        return {"log_loss": _safe_divide(self.total_loss, self.count)}
+
+
+class AccuracyAccumulator(MetricAccumulator):
+    """
+    Exact accuracy, predicting positive above the threshold
+    """
+
+    def __init__(
+        self, schema: Schema, y_pred_col: str, threshold: float = 0.5
+    ):
+        super().__init__(schema, y_pred_col)
+        self.threshold = threshold
+        self.correct = 0
+        self.count = 0
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        y_true, y_pred = self._get_arrays(chunk)
+        self.correct += int(((y_pred > self.threshold) == (y_true > 0)).sum())
+        self.count += len(y_true)
+
+    def merge(self, other: "AccuracyAccumulator") -> "AccuracyAccumulator":
+        self.correct += other.correct
+        self.count += other.count
+        return self
+
+    def result(self) -> Dict[str, float]:
+        return {"accuracy_score": _safe_divide(self.correct, self.count)}
+
+
+class HistogramAUCAccumulator(MetricAccumulator):
+    """
+    Approximate ROC AUC from histograms of positive and negative scores
+    Scores must be in [score_min, score_max], eg. probabilities in [0, 1]
+    Pairs in the same bin count as ties, which is the only source of error
+    More bins means a smaller error, see error_bound
+    """
+
+    def __init__(
+        self,
+        schema: Schema,
+        y_pred_col: str,
+        num_bins: int = 10000,
+        score_min: float = 0.0,
+        score_max: float = 1.0,
+    ):
+        """
+        Set score_min and score_max for scores that aren't probabilities,
+        eg. logits, scores outside the range raise an error
+        """
+        super().__init__(schema, y_pred_col)
+        if score_max <= score_min:
+            raise ValueError(
+                f"score_max must be greater than score_min, "
+                f"got {score_min} and {score_max}"
+            )
+        self.num_bins = num_bins
+        self.score_min = score_min
+        self.score_max = score_max
+        self.positives = np.zeros(num_bins, dtype=np.int64)
+        self.negatives = np.zeros(num_bins, dtype=np.int64)
+
+    def _get_bins(self, y_pred: np.ndarray) -> np.ndarray:
+        # Also catches nan scores
+        in_range = (y_pred >= self.score_min) & (y_pred <= self.score_max)
+        if not in_range.all():
+            raise ValueError(
+                f"Scores must be in [{self.score_min}, {self.score_max}], "
+                f"got {(~in_range).sum()} outside it"
+            )
+        scaled = (y_pred - self.score_min) / (self.score_max - self.score_min)
+        # Only score_max itself falls past the last bin
+        return np.minimum(
+            (scaled * self.num_bins).astype(np.int64), self.num_bins - 1
+        )
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        y_true, y_pred = self._get_arrays(chunk)
+        bins = self._get_bins(y_pred)
+        positive = y_true > 0
+        self.positives += np.bincount(bins[positive], minlength=self.num_bins)
+        self.negatives += np.bincount(bins[~positive], minlength=self.num_bins)
+
+    def merge(
+        self, other: "HistogramAUCAccumulator"
+    ) -> "HistogramAUCAccumulator":
+        if (other.num_bins, other.score_min, other.score_max) != (
+            self.num_bins,
+            self.score_min,
+            self.score_max,
+        ):
+            raise ValueError("Can only merge accumulators with equal bins")
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def _num_pairs(self) -> float:
+        return float(self.positives.sum()) * float(self.negatives.sum())
+
+    def error_bound(self) -> float:
+        """
+        Max absolute difference from the exact AUC
+        Half the proportion of positive/negative pairs that share a bin
+        """
+        same_bin_pairs = (self.positives * self.negatives.astype(float)).sum()
+        return _safe_divide(same_bin_pairs, 2 * self._num_pairs())
+
+    def result(self) -> Dict[str, float]:
+        # Negatives in lower bins are ranked correctly, same bin is a tie
+        negatives_below = np.cumsum(self.negatives) - self.negatives
+        correct_pairs = (
+            self.positives * (negatives_below + 0.5 * self.negatives)
+        ).sum()
+        return {
+            "roc_auc_score": _safe_divide(correct_pairs, self._num_pairs())
+        }
+
+
+class RankingMetricAccumulator(MetricAccumulator):
+    """
+    Ranking metrics averaged over queries
+    Assumes a query never spans more than one chunk
+    """
+
+    def __init__(
+        self, schema: Schema, y_pred_col: str, ranking_metrics: List[str]
+    ):
+        super().__init__(schema, y_pred_col)
+        self.ranking_metrics = ranking_metrics
+        self.totals = {metric: 0.0 for metric in ranking_metrics}
+        self.count = 0
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        query_index = get_rankable_query_index(chunk, self.schema)
+        y_true, y_pred = self._get_arrays(chunk)
+        ranked = RankedQueries.create_instance_from_query_index(
+            query_index, y_true, y_pred
+        )
+        for metric in self.ranking_metrics:
+            values = calculate_ranking_metric_values(ranked, metric)
+            self.totals[metric] += values.sum()
+        self.count += query_index.num_queries
+
+    def merge(
+        self, other: "RankingMetricAccumulator"
+    ) -> "RankingMetricAccumulator":
+        for metric in self.ranking_metrics:
+            self.totals[metric] += other.totals[metric]
+        self.count += other.count
+        return self
+
+    def result(self) -> Dict[str, float]:
+        return {
+            metric: _safe_divide(total, self.count)
+            for metric, total in self.totals.items()
+        }
+
+
+def accumulate_metrics(
+    chunks: Iterable[pd.DataFrame], accumulators: List[MetricAccumulator]
+) -> Dict[str, float]:
+    """
+    Stream chunks, eg. from pd.read_csv(chunksize=...), through accumulators
+    Returns all of the accumulated metrics
+    """
+    for chunk in chunks:
+        for accumulator in accumulators:
+            accumulator.update(chunk)
+    metrics = {}
+    for accumulator in accumulators:
+        metrics.update(accumulator.result())
+    return metrics
@@ -0,0 +1,104 @@
+from typing import List, Optional
+import logging
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.utils.query_index import QueryIndex
+from search_ranking_utils.evaluation.metrics import (
+    get_query_ranking_metrics,
+    get_rankable_query_index,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_bootstrap_means(
+    query_metrics: np.ndarray,
+    num_resamples: int = 1000,
+    batch_size: int = 100,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Resample queries with replacement and take the mean of each column
+    query_metrics is (num_queries x num_columns), eg. one column per model
+    Each resample is a row of multinomial counts of how often a query is drawn
+    Means for a batch of resamples are a single matrix multiply
+    Every column uses the same resamples, so differences are paired
+    Returns (num_resamples x num_columns)
+    """
+    rng = np.random.default_rng(seed)
+    num_queries = query_metrics.shape[0]
+    query_probs = np.full(num_queries, 1 / num_queries)
+    means = []
+    for start in range(0, num_resamples, batch_size):
+        num_batch = min(batch_size, num_resamples - start)
+        weights = rng.multinomial(num_queries, query_probs, size=num_batch)
+        means.append(weights @ query_metrics / num_queries)
+    return np.concatenate(means)
+
+
+def bootstrap_ranking_metrics(
+    df: pd.DataFrame,
+    schema: Schema,
+    y_pred_cols: List[str],
+    ranking_metrics: List[str],
+    baseline_col: Optional[str] = None,
+    num_resamples: int = 1000,
+    confidence_level: float = 0.95,
+    seed: Optional[int] = None,
+    query_index: Optional[QueryIndex] = None,
+) -> pd.DataFrame:
+    """
+    Percentile bootstrap confidence intervals for ranking metrics
+    Per query metrics are calculated once per model, then resampled
+    If baseline_col is given, also compare every model to it
+    The paired difference has its own interval and a two-sided p-value
+    Returns one row per (ranking_metric, y_pred_col)
+    """
+    if baseline_col is not None and baseline_col not in y_pred_cols:
+        y_pred_cols = y_pred_cols + [baseline_col]
+    query_index = get_rankable_query_index(df, schema, query_index)
+    columns = []
+    values = []
+    for y_pred_col in y_pred_cols:
+        query_metrics = get_query_ranking_metrics(
+            df, schema, y_pred_col, ranking_metrics, query_index
+        )
+        for metric, metric_values in query_metrics.items():
+            columns.append((metric, y_pred_col))
+            values.append(metric_values)
+    values = np.stack(values, axis=1)
+    logger.info(
+        f"Bootstrapping {values.shape[1]} metrics over "
+        f"{values.shape[0]} queries with {num_resamples} resamples"
+    )
+    means = get_bootstrap_means(values, num_resamples, seed=seed)
+    alpha = (1 - confidence_level) / 2
+    results = pd.DataFrame(
+        {
+            "value": values.mean(axis=0),
+            "lower": np.quantile(means, alpha, axis=0),
+            "upper": np.quantile(means, 1 - alpha, axis=0),
+        },
+        index=pd.MultiIndex.from_tuples(
+            columns, names=["ranking_metric", "y_pred_col"]
+        ),
+    )
+    if baseline_col is None:
+        return results
+
+    baseline_positions = [
+        columns.index((metric, baseline_col)) for metric, _ in columns
+    ]
+    diffs = means - means[:, baseline_positions]
+    # How often the resampled difference lands either side of zero
+    p_values = 2 * np.minimum(
+        (diffs <= 0).mean(axis=0), (diffs >= 0).mean(axis=0)
+    )
+    results["diff"] = results["value"].to_numpy() - (
+        results["value"].to_numpy()[baseline_positions]
+    )
+    results["diff_lower"] = np.quantile(diffs, alpha, axis=0)
+    results["diff_upper"] = np.quantile(diffs, 1 - alpha, axis=0)
+    results["p_value"] = np.minimum(p_values, 1.0)
+    return results
@@ -1,10 +1,125 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+import logging
 import numpy as np
 import pandas as pd
 from importlib import import_module
 from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.utils.query_index import QueryIndex
+from search_ranking_utils.utils.shared_memory import (
+    SharedArrays,
+    SharedArraySpec,
+    get_num_jobs,
+)
+
+logger = logging.getLogger(__name__)
 
 SKLEARN_METRICS_MODULE = import_module("sklearn.metrics")
+# Eg. ndcg_score@5 is NDCG using the top 5 results only
+RANKING_METRIC_CUTOFF_SEPARATOR = "@"
+
+
+@dataclass
+class SortedPredictions:
+    """
+    Labels and scores converted and sorted by descending score once
+    Shared by every fused pointwise metric
+    """
+
+    y_true: np.ndarray
+    y_pred: np.ndarray
+
+    @classmethod
+    def create_instance_from_arrays(
+        cls, y_true: np.ndarray, y_pred: np.ndarray
+    ):
+        y_true = np.asarray(y_true, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        if len(y_true) != len(y_pred):
+            raise ValueError("y_true and y_pred must be the same length")
+        order = np.argsort(-y_pred, kind="stable")
+        return cls(y_true=y_true[order], y_pred=y_pred[order])
+
+    def _get_curve_counts(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        True and false positives at each distinct score threshold
+        Tied scores share a threshold, the same as sklearn
+        """
+        threshold_idxs = np.append(
+            np.flatnonzero(np.diff(self.y_pred)), len(self.y_pred) - 1
+        )
+        tps = np.cumsum(self.y_true)[threshold_idxs]
+        fps = 1 + threshold_idxs - tps
+        return tps, fps
+
+    def roc_auc(self) -> float:
+        tps, fps = self._get_curve_counts()
+        if tps[-1] == 0 or fps[-1] == 0:
+            raise ValueError("y_true must contain positives and negatives")
+        tpr = np.concatenate([[0], tps / tps[-1]])
+        fpr = np.concatenate([[0], fps / fps[-1]])
+        # Trapezoidal area under the curve
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def average_precision(self) -> float:
+        """
+        Precision at each threshold weighted by the increase in recall
+        """
+        tps, fps = self._get_curve_counts()
+        if tps[-1] == 0:
+            raise ValueError("y_true must contain positives")
+        precision = tps / (tps + fps)
+        recall = np.concatenate([[0], tps / tps[-1]])
+        return float(np.sum(np.diff(recall) * precision))
+
+    def log_loss(self) -> float:
+        eps = np.finfo(self.y_pred.dtype).eps
+        y_pred = np.clip(self.y_pred, eps, 1 - eps)
+        losses = -(
+            self.y_true * np.log(y_pred)
+            + (1 - self.y_true) * np.log(1 - y_pred)
+        )
+        return float(losses.mean())
+
+    def brier_score(self) -> float:
+        return float(np.mean((self.y_pred - self.y_true) ** 2))
+
+    def calibration_bins(self, num_bins: int = 10) -> pd.DataFrame:
+        """
+        Mean prediction and mean target in equal width bins over [0, 1]
+        Empty bins are dropped
+        """
+        bins = np.clip((self.y_pred * num_bins).astype(int), 0, num_bins - 1)
+        counts = np.bincount(bins, minlength=num_bins)
+        pred_sums = np.bincount(bins, weights=self.y_pred, minlength=num_bins)
+        true_sums = np.bincount(bins, weights=self.y_true, minlength=num_bins)
+        non_empty = counts > 0
+        return pd.DataFrame(
+            {
+                "bin_lower": np.arange(num_bins)[non_empty] / num_bins,
+                "count": counts[non_empty],
+                "mean_prediction": pred_sums[non_empty] / counts[non_empty],
+                "mean_target": true_sums[non_empty] / counts[non_empty],
+            }
+        )
+
+    def expected_calibration_error(self, num_bins: int = 10) -> float:
+        """
+        Count weighted mean absolute gap between prediction and target
+        """
+        bins = self.calibration_bins(num_bins)
+        gaps = (bins["mean_prediction"] - bins["mean_target"]).abs()
+        return float((gaps * bins["count"]).sum() / bins["count"].sum())
+
+
+FUSED_POINTWISE_METRICS = {
+    "roc_auc_score": SortedPredictions.roc_auc,
+    "average_precision_score": SortedPredictions.average_precision,
+    "log_loss": SortedPredictions.log_loss,
+    "brier_score_loss": SortedPredictions.brier_score,
+    "expected_calibration_error": SortedPredictions.expected_calibration_error,
+}
 
 
 def get_pointwise_metrics(
@@ -15,11 +130,24 @@ def get_pointwise_metrics(
 ) -> Dict[str, float]:
     """
     Calculate all of the desired pointwise metrics on y_true and y_pred
+    Metrics in FUSED_POINTWISE_METRICS share a single conversion and sort
+    Any other sklearn metric is looked up by name
     """
     metrics = {}
+    sorted_predictions = None
     for metric in pointwise_metrics:
-        metric_func = getattr(SKLEARN_METRICS_MODULE, metric)
-        metrics[metric] = metric_func(df[schema.target], df[y_pred_col])
+        if metric in FUSED_POINTWISE_METRICS:
+            if sorted_predictions is None:
+                sorted_predictions = (
+                    SortedPredictions.create_instance_from_arrays(
+                        df[schema.target], df[y_pred_col]
+                    )
+                )
+            metric_func = FUSED_POINTWISE_METRICS[metric]
+            metrics[metric] = metric_func(sorted_predictions)
+        else:
+            metric_func = getattr(SKLEARN_METRICS_MODULE, metric)
+            metrics[metric] = metric_func(df[schema.target], df[y_pred_col])
     return metrics
 
 
@@ -32,39 +160,457 @@ def calculate_query_ranking_metric(
     Each pd.Series contains an array of actual/predicted scores
     Then average the query scores at the end
     """
-    metric_func = getattr(SKLEARN_METRICS_MODULE, ranking_metric_name)
+    metric_name, k = _parse_ranking_metric_name(ranking_metric_name)
+    metric_func = getattr(SKLEARN_METRICS_MODULE, metric_name)
+    metric_kwargs = {} if k is None else {"k": k}
     query_metrics = np.array([])
     if len(y_true) != len(y_pred):
         raise ValueError("y_true and y_pred must be the same length")
     for i in range(len(y_true)):
         # Needs to be 2-D for ranking metric calculation
-        y_true_arr = np.array(y_true[i]).reshape(1, -1)
-        y_pred_arr = np.array(y_pred[i]).reshape(1, -1)
+        y_true_arr = np.array(y_true.iloc[i]).reshape(1, -1)
+        y_pred_arr = np.array(y_pred.iloc[i]).reshape(1, -1)
         query_metrics = np.append(
-            query_metrics, metric_func(y_true_arr, y_pred_arr)
+            query_metrics, metric_func(y_true_arr, y_pred_arr, **metric_kwargs)
         )
     return query_metrics.mean()
 
 
+@dataclass
+class RankedQueries:
+    """
+    Flat labels and scores, sorted by (query, -score)
+    Queries are stored contiguously, query i is offsets[i]:offsets[i + 1]
+    Created once and shared by every segmented ranking metric
+    """
+
+    y_true: np.ndarray
+    y_pred: np.ndarray
+    offsets: np.ndarray
+    query_ids: np.ndarray
+    ranks: np.ndarray
+
+    @property
+    def num_queries(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @classmethod
+    def create_instance_from_arrays(
+        cls, y_true: np.ndarray, y_pred: np.ndarray, offsets: np.ndarray
+    ):
+        """
+        Rows must already be contiguous per query
+        One stable sort puts each query in descending score order
+        Ties keep their input order
+        """
+        y_true = np.asarray(y_true, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(y_true) != len(y_pred):
+            raise ValueError("y_true and y_pred must be the same length")
+        if offsets[0] != 0 or offsets[-1] != len(y_true):
+            raise ValueError("offsets must start at 0 and end at len(y_true)")
+        query_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        order = np.lexsort((-y_pred, query_ids))
+        return cls(
+            y_true=y_true[order],
+            y_pred=y_pred[order],
+            offsets=offsets,
+            query_ids=query_ids,
+            # 0-indexed position of each row within its query
+            ranks=np.arange(len(y_true)) - offsets[query_ids],
+        )
+
+    @classmethod
+    def create_instance_from_query_index(
+        cls, query_index: QueryIndex, y_true: np.ndarray, y_pred: np.ndarray
+    ):
+        return cls.create_instance_from_arrays(
+            y_true=query_index.gather(y_true),
+            y_pred=query_index.gather(y_pred),
+            offsets=query_index.offsets,
+        )
+
+    def relevant(self) -> np.ndarray:
+        return (self.y_true > 0).astype(np.float64)
+
+    def segment_sum(self, values: np.ndarray) -> np.ndarray:
+        return np.bincount(
+            self.query_ids, weights=values, minlength=self.num_queries
+        )
+
+    def segment_cumsum(self, values: np.ndarray) -> np.ndarray:
+        """
+        Running sum which restarts at the start of every query
+        """
+        cumsum = np.cumsum(values)
+        starts = self.offsets[:-1]
+        # Value of the running sum just before each query starts
+        before = np.where(starts > 0, cumsum[starts - 1], 0.0)
+        return cumsum - np.repeat(before, self.sizes)
+
+    def segment_max(self, values: np.ndarray) -> np.ndarray:
+        result = np.zeros(self.num_queries)
+        non_empty = self.sizes > 0
+        result[non_empty] = np.maximum.reduceat(
+            values, self.offsets[:-1][non_empty]
+        )
+        return result
+
+
+def _parse_ranking_metric_name(
+    ranking_metric_name: str,
+) -> Tuple[str, Optional[int]]:
+    """
+    Split a metric name like ndcg_score@5 into (ndcg_score, 5)
+    """
+    if RANKING_METRIC_CUTOFF_SEPARATOR not in ranking_metric_name:
+        return ranking_metric_name, None
+    metric_name, k = ranking_metric_name.split(RANKING_METRIC_CUTOFF_SEPARATOR)
+    return metric_name, int(k)
+
+
+def _get_discount(ranks: np.ndarray, k: Optional[int]) -> np.ndarray:
+    """
+    Log2 discount by rank, zero after the cutoff
+    Computed the same way as sklearn so the numbers match
+    """
+    discount = 1 / (np.log(ranks + 2) / np.log(2))
+    if k is not None:
+        discount[ranks >= k] = 0
+    return discount
+
+
+def _segmented_dcg(
+    ranked: RankedQueries, k: Optional[int], ignore_ties: bool = False
+) -> np.ndarray:
+    """
+    DCG for every query
+    Tied scores get the average gain of their group, like sklearn
+    """
+    discount = _get_discount(ranked.ranks, k)
+    if ignore_ties:
+        return ranked.segment_sum(ranked.y_true * discount)
+    n = len(ranked.y_true)
+    if n == 0:
+        return np.zeros(ranked.num_queries)
+    # A tie group starts at each new query or each new score
+    group_start = np.ones(n, dtype=bool)
+    group_start[1:] = (ranked.query_ids[1:] != ranked.query_ids[:-1]) | (
+        ranked.y_pred[1:] != ranked.y_pred[:-1]
+    )
+    starts = np.flatnonzero(group_start)
+    group_sizes = np.diff(np.append(starts, n))
+    group_gains = np.add.reduceat(ranked.y_true, starts) / group_sizes
+    group_discounts = np.add.reduceat(discount, starts)
+    return np.bincount(
+        ranked.query_ids[starts],
+        weights=group_gains * group_discounts,
+        minlength=ranked.num_queries,
+    )
+
+
+def _segmented_ideal_dcg(
+    ranked: RankedQueries, k: Optional[int]
+) -> np.ndarray:
+    """
+    DCG if each query was perfectly ranked by y_true
+    """
+    order = np.lexsort((-ranked.y_true, ranked.query_ids))
+    ideal = RankedQueries(
+        y_true=ranked.y_true[order],
+        y_pred=ranked.y_true[order],
+        offsets=ranked.offsets,
+        query_ids=ranked.query_ids,
+        ranks=ranked.ranks,
+    )
+    return _segmented_dcg(ideal, k, ignore_ties=True)
+
+
+def _segmented_ndcg(ranked: RankedQueries, k: Optional[int]) -> np.ndarray:
+    gain = _segmented_dcg(ranked, k)
+    normalising_gain = _segmented_ideal_dcg(ranked, k)
+    # Queries with no relevant items score 0
+    all_irrelevant = normalising_gain == 0
+    gain[all_irrelevant] = 0
+    gain[~all_irrelevant] /= normalising_gain[~all_irrelevant]
+    return gain
+
+
+def _segmented_average_precision(
+    ranked: RankedQueries, k: Optional[int]
+) -> np.ndarray:
+    """
+    Mean of precision@i at every relevant rank i
+    With a cutoff, divide by min(k, num relevant)
+    """
+    relevant = ranked.relevant()
+    num_relevant = ranked.segment_sum(relevant)
+    precision = ranked.segment_cumsum(relevant) / (ranked.ranks + 1)
+    if k is not None:
+        relevant = relevant * (ranked.ranks < k)
+        num_relevant = np.minimum(num_relevant, k)
+    total_precision = ranked.segment_sum(relevant * precision)
+    return np.divide(
+        total_precision,
+        num_relevant,
+        out=np.zeros(ranked.num_queries),
+        where=num_relevant > 0,
+    )
+
+
+def _segmented_reciprocal_rank(
+    ranked: RankedQueries, k: Optional[int]
+) -> np.ndarray:
+    """
+    1 / rank of the first relevant item, 0 if there isn't one
+    """
+    reciprocal_ranks = ranked.relevant() / (ranked.ranks + 1)
+    if k is not None:
+        reciprocal_ranks[ranked.ranks >= k] = 0
+    return ranked.segment_max(reciprocal_ranks)
+
+
+def _segmented_precision(
+    ranked: RankedQueries, k: Optional[int]
+) -> np.ndarray:
+    """
+    Proportion of the top k that are relevant
+    Queries shorter than k are still divided by k
+    Without a cutoff, use the whole query
+    """
+    relevant = ranked.relevant()
+    if k is None:
+        return ranked.segment_sum(relevant) / ranked.sizes
+    return ranked.segment_sum(relevant * (ranked.ranks < k)) / k
+
+
+SEGMENTED_RANKING_METRICS = {
+    "ndcg_score": _segmented_ndcg,
+    "dcg_score": _segmented_dcg,
+    "average_precision": _segmented_average_precision,
+    "reciprocal_rank": _segmented_reciprocal_rank,
+    "precision": _segmented_precision,
+}
+
+
+def is_segmented_ranking_metric(ranking_metric_name: str) -> bool:
+    metric_name, _ = _parse_ranking_metric_name(ranking_metric_name)
+    return metric_name in SEGMENTED_RANKING_METRICS
+
+
+def calculate_segmented_ranking_metric(
+    ranked: RankedQueries, ranking_metric_name: str
+) -> np.ndarray:
+    """
+    Calculate a ranking metric for every query at once
+    Returns one value per query
+    """
+    metric_name, k = _parse_ranking_metric_name(ranking_metric_name)
+    if metric_name not in SEGMENTED_RANKING_METRICS:
+        raise ValueError(
+            f"ranking_metric_name must be in "
+            f"{list(SEGMENTED_RANKING_METRICS)}, got {metric_name}"
+        )
+    return SEGMENTED_RANKING_METRICS[metric_name](ranked, k)
+
+
+def get_rankable_query_index(
+    df: pd.DataFrame,
+    schema: Schema,
+    query_index: Optional[QueryIndex] = None,
+) -> QueryIndex:
+    """
+    Group the df by query, only keeping queries that can be ranked
+    Pass in an existing query_index to reuse its grouping
+    """
+    if query_index is None:
+        query_index = QueryIndex.create_instance_from_df(df, schema)
+    # Remove all queries of size 1 as can't rank
+    # Also remove any queries which had no relevant items
+    return query_index.filter_small_queries(
+        min_size=2
+    ).filter_queries_without_positives(df[schema.target].to_numpy())
+
+
 def get_ranking_metrics(
     df: pd.DataFrame,
     schema: Schema,
     y_pred_col: str,
     ranking_metrics: List[str],
+    query_index: Optional[QueryIndex] = None,
+    n_jobs: int = 1,
+    executor: Optional[Executor] = None,
 ) -> Dict[str, float]:
-    metrics = {}
-    y_true_queries = df.groupby(schema.query_col)[schema.target].agg(list)
-    # Remove all queries of size 1 as can't rank
-    # Also remove any queries which had no relevant items
-    drop_indices = (y_true_queries.apply(lambda x: len(x) > 1)) & (
-        y_true_queries.apply(lambda x: sum(x) > 0)
+    """
+    Average each ranking metric over queries
+    Metrics in SEGMENTED_RANKING_METRICS are computed for every query at once
+    Any other sklearn ranking metric is computed query by query
+    Pass in a query_index to evaluate many y_pred_cols with one grouping
+
+    With n_jobs > 1, queries are split into n_jobs contiguous shards
+    Shards are evaluated in a process pool, or the executor if given
+    n_jobs=-1 uses one shard per CPU
+    """
+    n_jobs = get_num_jobs(n_jobs)
+    if n_jobs == 1 and executor is None:
+        query_metrics = get_query_ranking_metrics(
+            df, schema, y_pred_col, ranking_metrics, query_index
+        )
+        return {
+            metric: values.mean() for metric, values in query_metrics.items()
+        }
+    query_index = get_rankable_query_index(df, schema, query_index)
+    return _get_sharded_ranking_metrics(
+        query_index.gather(df[schema.target].to_numpy(dtype=np.float64)),
+        query_index.gather(df[y_pred_col].to_numpy(dtype=np.float64)),
+        query_index.offsets,
+        ranking_metrics,
+        n_jobs,
+        executor,
     )
-    y_true_queries = y_true_queries[drop_indices]
-    y_pred_queries = df.groupby(schema.query_col)[y_pred_col].agg(list)[
-        drop_indices
-    ]
-    for metric in ranking_metrics:
-        metrics[metric] = calculate_query_ranking_metric(
-            y_true_queries, y_pred_queries, metric
+
+
+def get_query_ranking_metrics(
+    df: pd.DataFrame,
+    schema: Schema,
+    y_pred_col: str,
+    ranking_metrics: List[str],
+    query_index: Optional[QueryIndex] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Like get_ranking_metrics, but return the value for every query
+    Queries are in the order of the rankable query_index
+    """
+    query_index = get_rankable_query_index(df, schema, query_index)
+    ranked = RankedQueries.create_instance_from_query_index(
+        query_index,
+        df[schema.target].to_numpy(dtype=np.float64),
+        df[y_pred_col].to_numpy(dtype=np.float64),
+    )
+    return {
+        metric: calculate_ranking_metric_values(ranked, metric)
+        for metric in ranking_metrics
+    }
+
+
+def calculate_ranking_metric_values(
+    ranked: RankedQueries, ranking_metric_name: str
+) -> np.ndarray:
+    """
+    Per query metric values, using sklearn if it isn't a segmented metric
+    """
+    if is_segmented_ranking_metric(ranking_metric_name):
+        return calculate_segmented_ranking_metric(ranked, ranking_metric_name)
+    metric_name, k = _parse_ranking_metric_name(ranking_metric_name)
+    metric_func = getattr(SKLEARN_METRICS_MODULE, metric_name)
+    metric_kwargs = {} if k is None else {"k": k}
+    split_points = ranked.offsets[1:-1]
+    return np.array(
+        [
+            metric_func(
+                y_true.reshape(1, -1), y_pred.reshape(1, -1), **metric_kwargs
+            )
+            for y_true, y_pred in zip(
+                np.split(ranked.y_true, split_points),
+                np.split(ranked.y_pred, split_points),
+            )
+        ]
+    )
+
+
+def _get_shard_bounds(offsets: np.ndarray, num_shards: int) -> np.ndarray:
+    """
+    Split queries into contiguous shards with roughly equal rows
+    Shard i is queries bounds[i]:bounds[i + 1], a query is never split
+    """
+    num_queries = len(offsets) - 1
+    row_targets = np.linspace(0, offsets[-1], num_shards + 1)[1:-1]
+    bounds = np.searchsorted(offsets, row_targets)
+    bounds = np.concatenate([[0], bounds, [num_queries]])
+    # Drop empty shards
+    return np.unique(bounds)
+
+
+def _evaluate_ranking_shard(
+    specs: Dict[str, SharedArraySpec],
+    query_start: int,
+    query_end: int,
+    ranking_metrics: List[str],
+) -> Dict[str, Tuple[float, int]]:
+    """
+    Runs in a worker, attaching to the shared arrays instead of pickling
+    Returns the sum and count of each metric so shards can be merged
+    """
+    blocks = {}
+    arrays = {}
+    offsets = ranked = None
+    try:
+        for key, spec in specs.items():
+            blocks[key], arrays[key] = spec.attach()
+        # Include the end offset of the last query
+        offsets_end = query_end + 1
+        offsets = arrays["offsets"][query_start:offsets_end]
+        row_start, row_end = offsets[0], offsets[-1]
+        ranked = RankedQueries.create_instance_from_arrays(
+            arrays["y_true"][row_start:row_end],
+            arrays["y_pred"][row_start:row_end],
+            offsets - row_start,
         )
+        shard_metrics = {}
+        for metric in ranking_metrics:
+            values = calculate_ranking_metric_values(ranked, metric)
+            shard_metrics[metric] = (values.sum(), len(values))
+    finally:
+        # Views must be released before the blocks can be closed
+        arrays.clear()
+        offsets = ranked = None
+        for shm in blocks.values():
+            shm.close()
+    return shard_metrics
+
+
+def _get_sharded_ranking_metrics(
+    y_true: np.ndarray,
+    y_pred: np.ndarray,
+    offsets: np.ndarray,
+    ranking_metrics: List[str],
+    n_jobs: int,
+    executor: Optional[Executor] = None,
+) -> Dict[str, float]:
+    bounds = _get_shard_bounds(offsets, n_jobs)
+    logger.info(f"Evaluating {len(offsets) - 1} queries in {n_jobs} shards")
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    try:
+        with SharedArrays() as shared:
+            shared.add("y_true", y_true)
+            shared.add("y_pred", y_pred)
+            shared.add("offsets", offsets)
+            futures = [
+                executor.submit(
+                    _evaluate_ranking_shard,
+                    shared.specs,
+                    query_start,
+                    query_end,
+                    ranking_metrics,
+                )
+                for query_start, query_end in zip(bounds[:-1], bounds[1:])
+            ]
+            shard_results = [future.result() for future in futures]
+    finally:
+        if own_executor:
+            executor.shutdown()
+    # Merge the sums and counts for exact global means
+    metrics = {}
+    for metric in ranking_metrics:
+        total = sum(result[metric][0] for result in shard_results)
+        count = sum(result[metric][1] for result in shard_results)
+        # Same as the mean of no queries in the serial path
+        metrics[metric] = total / count if count > 0 else np.nan
     return metrics
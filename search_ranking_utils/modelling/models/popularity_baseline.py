@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import Optional
 import numpy as np
 import pandas as pd
 
@@ -9,6 +9,8 @@ class PopularityBaseline:
     Stores a lookup table of item ids and target probability
     If id not found, optionall specify default
     Default not specified, use global target probability
+    Keeps target and row counts per item, so it can be updated with
+    partial_fit, eg. daily, without refitting on the full history
     """
 
     def __init__(
@@ -16,28 +18,77 @@ class PopularityBaseline:
         target_col: str,
         item_id_col: str,
         default_val: Optional[float] = None,
+        prior_strength: float = 0.0,
     ):
+        """
+        prior_strength adds that many rows at the global probability to
+        every item (Bayesian smoothing), so items with few rows are
+        pulled towards the global probability
+        """
         self.target_col = target_col
         self.item_id_col = item_id_col
         self.default_val = default_val
+        self.prior_strength = prior_strength
+        self._reset()
 
-    def fit(self, X: pd.DataFrame) -> None:
-        self.score_lookup = {}
-        scores = X.groupby(self.item_id_col)[self.target_col].mean()
-        for i in range(len(scores)):
-            item = scores.index[i]
-            prob = scores[i]
-            self.score_lookup[item] = prob
-        # Use global prob
-        if not self.default_val:
-            self.default_val = X[self.target_col].mean()
+    def _reset(self) -> None:
+        self.target_counts = pd.Series(dtype=np.float64)
+        self.row_counts = pd.Series(dtype=np.int64)
+        self.total_target = 0.0
+        self.total_rows = 0
+        self.scores = pd.Series(dtype=np.float64)
+
+    def fit(self, X: pd.DataFrame) -> "PopularityBaseline":
+        self._reset()
+        return self.partial_fit(X)
+
+    def partial_fit(self, X: pd.DataFrame) -> "PopularityBaseline":
+        """
+        Add a chunk of data to the counts
+        """
+        counts = X.groupby(self.item_id_col, observed=True)[
+            self.target_col
+        ].agg(["sum", "count"])
+        self.target_counts = self.target_counts.add(
+            counts["sum"], fill_value=0
+        )
+        self.row_counts = self.row_counts.add(
+            counts["count"], fill_value=0
+        ).astype(np.int64)
+        # groupby drops rows without an item id, which still count here
+        self.total_target += float(X[self.target_col].sum())
+        self.total_rows += int(X[self.target_col].count())
+        # Smoothed target probability per item
+        self.scores = (
+            self.target_counts + self.prior_strength * self.global_val
+        ) / (self.row_counts + self.prior_strength)
+        return self
+
+    @property
+    def global_val(self) -> float:
+        # No target seen yet, eg. an empty first chunk
+        if self.total_rows == 0:
+            return np.nan
+        return self.total_target / self.total_rows
 
-    def _get_score(self, item_id: str) -> float:
-        return self.score_lookup.get(item_id, self.default_val)
+    @property
+    def score_lookup(self) -> dict:
+        return self.scores.to_dict()
+
+    def _get_default_val(self) -> float:
+        # Use global prob
+        if self.default_val is None:
+            return self.global_val
+        return self.default_val
 
-    def predict_proba(self, X: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
         """
-        Return [p(target=0), p(target=1)] to match sklearn
+        Return [p(target=0), p(target=1)] columns to match sklearn
         """
-        scores = X[self.item_id_col].apply(lambda x: self._get_score(x))
-        return 1 - scores.values, scores.values
+        scores = (
+            X[self.item_id_col]
+            .map(self.scores)
+            .to_numpy(dtype=np.float64, na_value=np.nan)
+        )
+        scores[np.isnan(scores)] = self._get_default_val()
+        return np.column_stack([1 - scores, scores])
@@ -1,6 +1,8 @@
 import logging
-from typing import Tuple
+from typing import Tuple, Union, Optional
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from sklearn.preprocessing import OneHotEncoder
 from search_ranking_utils.utils.schema import Schema, CategoricalFeature
 
@@ -28,33 +30,104 @@ def normalise_numerical_features(
     return df
 
 
+def create_vocab_dtype(vocab: list) -> pd.CategoricalDtype:
+    """
+    Categorical dtype whose codes are positions in the vocab
+    Build once and reuse, so lookups are array operations
+    """
+    return pd.CategoricalDtype(categories=vocab)
+
+
+def get_category_codes(
+    values: pd.Series,
+    vocab_dtype: pd.CategoricalDtype,
+    oov_code: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Integer code of each value in the vocab
+    Values not in the vocab (including nulls) get oov_code, or -1 if None
+    """
+    codes = pd.Categorical(values, dtype=vocab_dtype).codes.astype(np.int64)
+    if oov_code is not None:
+        codes[codes == -1] = oov_code
+    return codes
+
+
+def _whole_floats_to_ints(values: Union[pd.Series, list]) -> np.ndarray:
+    """
+    Object array where whole number floats are ints, eg. 123.0 -> 123
+    Int columns become float when a chunk has nulls, so ids would
+    otherwise hash differently from chunk to chunk
+    """
+    if isinstance(values, list):
+        # numpy would cast a mixed list to strings, eg. 123.0 -> "123.0"
+        values = np.array(values, dtype=object)
+    arr = np.asarray(values)
+    if arr.dtype.kind == "f":
+        # Larger floats can't be cast to int64
+        whole = (np.floor(arr) == arr) & (np.abs(arr) < 2**63)
+        result = arr.astype(object)
+        result[whole] = arr[whole].astype(np.int64)
+        return result
+    arr = arr.astype(object)
+    # Only mixed object columns can hold floats, eg. raw records
+    if pd.api.types.infer_dtype(arr, skipna=False) in ["string", "integer"]:
+        return arr
+    return np.array(
+        [
+            int(v) if isinstance(v, float) and v.is_integer() else v
+            for v in arr
+        ],
+        dtype=object,
+    )
+
+
+def hash_categories(
+    values: Union[pd.Series, list], num_buckets: int
+) -> np.ndarray:
+    """
+    Bucket of each value, from a vectorized hash of its string form
+    Stable across runs and dtypes, eg. 123, 123.0 and "123" share a bucket
+    Nulls should be imputed first
+    """
+    hashes = pd.util.hash_array(_whole_floats_to_ints(values))
+    return (hashes % np.uint64(num_buckets)).astype(np.int64)
+
+
 def map_oov_categories(df: pd.DataFrame, schema: Schema) -> pd.DataFrame:
     """
     Map categories which aren't in the vocab to OOV
     This helps reduce the number of features
     """
-    copied_df = df.copy()
+    mapped = {}
     for f in schema.categorical_features:
         if f.max_categories:
-            vocab_set = set(schema.vocabs[f.name])
-            copied_df[f.name] = copied_df[f.name].apply(
-                lambda x: (
-                    x if x in vocab_set else CategoricalFeature.DEFAULT_VAL
-                )
+            vocab = schema.vocabs[f.name]
+            codes = get_category_codes(df[f.name], create_vocab_dtype(vocab))
+            # Code -1 indexes the last element, the OOV category
+            lookup = np.array(
+                list(vocab) + [CategoricalFeature.DEFAULT_VAL], dtype=object
             )
-    return copied_df
+            mapped[f.name] = lookup[codes]
+    return df.assign(**mapped)
 
 
 def create_one_hot_encoder(
-    df: pd.DataFrame, schema: Schema
+    df: pd.DataFrame, schema: Schema, sparse_output: bool = False
 ) -> "OneHotEncoder":
     """
     Create a one hot encoder object to encode categorical features
     Needs to be used for preprocessing validation data as well
+    Use sparse_output for high cardinality features
+    Hashed features aren't one hot encoded
     """
-    categorical_feature_names = [f.name for f in schema.categorical_features]
+    categorical_feature_names = [
+        f.name for f in schema.categorical_features if not f.hash_buckets
+    ]
     # Don't want it to error on validation data with unknown category
-    encoder = OneHotEncoder(handle_unknown="ignore", sparse_output=False)
+    encoder = OneHotEncoder(
+        handle_unknown="ignore", sparse_output=sparse_output
+    )
     encoder.fit(df[categorical_feature_names])
     return encoder
 
@@ -74,11 +147,14 @@ def one_hot_encode_categorical_features(
         f = categorical_features[i]
         for category in one_hot_encoder.categories_[i]:
             columns.append(f"{f}_{category}")
-    encoded = pd.DataFrame(
-        one_hot_encoder.transform(categorical_data),
-        columns=columns,
-        index=df.index,
-    )
+    encoded = one_hot_encoder.transform(categorical_data)
+    # Sparse encoders give pandas sparse columns
+    if sparse.issparse(encoded):
+        encoded = pd.DataFrame.sparse.from_spmatrix(
+            encoded, columns=columns, index=df.index
+        )
+    else:
+        encoded = pd.DataFrame(encoded, columns=columns, index=df.index)
     # Drop original categorical features and concat on
     df = df.drop(categorical_features, axis=1)
     return pd.concat([df, encoded], axis=1)
@@ -88,19 +164,24 @@ def drop_cols(df: pd.DataFrame, schema: Schema) -> pd.DataFrame:
     """
     Drop columns not specified in the schema
     """
-    features = [f.name for f in schema.all_features]
-    features.append(schema.target)
-    features.append(schema.query_col)
-    return df[features]
+    return df[schema.get_columns()]
 
 
 def split_dataset(
-    df: pd.DataFrame, schema: Schema
-) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    df: pd.DataFrame, schema: Schema, sparse_output: bool = False
+) -> Tuple[pd.DataFrame, Union[pd.DataFrame, sparse.csr_matrix], pd.Series]:
     """
     Return the original df, X and y
     Assumes data already preprocessed
+    With sparse_output, X is a CSR matrix, for sklearn/XGBoost
+    Sparse feature columns are never densified, dense ones are converted
     """
     X = df[schema.get_model_features()]
+    if sparse_output:
+        is_sparse = X.dtypes.apply(lambda d: isinstance(d, pd.SparseDtype))
+        if is_sparse.all():
+            X = X.sparse.to_coo().tocsr()
+        else:
+            X = sparse.csr_matrix(X.to_numpy())
     y = df[schema.target]
     return df, X, y
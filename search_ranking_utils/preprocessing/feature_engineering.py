@@ -1,10 +1,42 @@
+from typing import List, Optional
 from datetime import datetime
+import os
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
+from search_ranking_utils.preprocessing.text_embedding import (
+    TextEmbedder,
+    ProductEmbeddingIndex,
+)
 
 EMBEDDING_MODEL = "msmarco-MiniLM-L-6-v3"
-model = SentenceTransformer(EMBEDDING_MODEL)
+# Timestamp part to (first value, period) for sin/cos encodings
+CYCLICAL_PERIODS = {
+    "second": (0, 60),
+    "minute": (0, 60),
+    "hour": (0, 24),
+    "weekday": (0, 7),
+    "day": (1, 31),
+    "month": (1, 12),
+    "dayofyear": (1, 366),
+}
+# Shared so repeated texts are cached across calls
+# The model is only loaded the first time text is embedded
+text_embedder = TextEmbedder(model_name=EMBEDDING_MODEL)
+
+
+def set_text_embedder(embedder: TextEmbedder) -> None:
+    """
+    Replace the default embedder, eg. a different model or a store
+    """
+    global text_embedder
+    text_embedder = embedder
+
+
+def warm_up_text_embedder() -> None:
+    """
+    Load the default embedding model now rather than on first use
+    """
+    text_embedder.warm_up()
 
 
 def get_cosine_similarity(emb_1: np.ndarray, emb2: np.ndarray):
@@ -18,8 +50,27 @@ def get_cosine_similarity(emb_1: np.ndarray, emb2: np.ndarray):
     )
 
 
+def get_normalised_cosine_similarity(
+    emb_1: np.ndarray, emb_2: np.ndarray
+) -> np.ndarray:
+    """
+    Same as get_cosine_similarity, for rows already normalised
+    So it is just the row-wise dot product
+    All zero rows have no direction, so get nan like get_cosine_similarity
+    """
+    scores = np.einsum("ij,ij->i", emb_1, emb_2)
+    zero_rows = ~emb_1.any(axis=1) | ~emb_2.any(axis=1)
+    scores[zero_rows] = np.nan
+    return scores
+
+
 def calculate_text_cosine_similarity(
-    df: pd.DataFrame, text_col_1: str, text_col_2: str
+    df: pd.DataFrame,
+    text_col_1: str,
+    text_col_2: str,
+    embedder: Optional[TextEmbedder] = None,
+    batch_size: Optional[int] = None,
+    embeddings_dir: Optional[str] = None,
 ) -> np.ndarray:
     """
     Given two pieces of text, calculate their similarity score
@@ -27,10 +78,32 @@ def calculate_text_cosine_similarity(
     Then take the cosine similarity
 
     Batching the data makes this much quicker
+    Each distinct text across both columns is only embedded once,
+    eg. a query repeated on every impression, then scattered back
+    Pass an embedder to use a different model, cache or on-disk store
+    eg. TextEmbedder(model_name=..., num_workers=4) overlaps tokenization
+    and inference, set_text_embedder makes it the default
+    With batch_size, rows are embedded and scored one batch at a time,
+    so peak memory is O(batch_size) rather than two full N x E matrices
+    With embeddings_dir, the normalised embeddings are also saved as
+    float16 <text_col>.npy files, which can be memory mapped
     Return an array of the similairty scores for each pair
     """
-    text_embeddings_1 = model.encode(df[text_col_1].values)
-    text_embeddings_2 = model.encode(df[text_col_2].values)
+    embedder = embedder or text_embedder
+    if batch_size is not None or embeddings_dir is not None:
+        return _calculate_batched_cosine_similarity(
+            df[text_col_1].values,
+            df[text_col_2].values,
+            embedder,
+            batch_size or len(df),
+            embeddings_dir,
+            [text_col_1, text_col_2],
+        )
+    embeddings = embedder.embed(
+        np.concatenate([df[text_col_1].values, df[text_col_2].values])
+    )
+    embedder.flush()
+    text_embeddings_1, text_embeddings_2 = np.split(embeddings, [len(df)])
     # We only care about the diagonal as that holds the right similarity scores
     # Eg. [0][0] is first search query with first product
     # [4][4] is fifth search query with fifth product
@@ -38,6 +111,79 @@ def calculate_text_cosine_similarity(
     return get_cosine_similarity(text_embeddings_1, text_embeddings_2)
 
 
+def _calculate_batched_cosine_similarity(
+    texts_1: np.ndarray,
+    texts_2: np.ndarray,
+    embedder: TextEmbedder,
+    batch_size: int,
+    embeddings_dir: Optional[str],
+    names: List[str],
+) -> np.ndarray:
+    """
+    Each batch is normalised once, then the row-wise dot product is
+    the cosine similarity
+    Nothing is saved for empty input, as the embedding dim isn't known
+    """
+    num_rows = len(texts_1)
+    scores = np.empty(num_rows, dtype=np.float32)
+    if num_rows == 0:
+        return scores
+    stored = None
+    for start in range(0, num_rows, batch_size):
+        end = min(start + batch_size, num_rows)
+        embeddings = embedder.embed(
+            np.concatenate([texts_1[start:end], texts_2[start:end]]),
+            normalise=True,
+        )
+        batch_1, batch_2 = np.split(embeddings, [end - start])
+        scores[start:end] = get_normalised_cosine_similarity(batch_1, batch_2)
+        if embeddings_dir is not None:
+            # Created once the embedding dim is known
+            if stored is None:
+                os.makedirs(embeddings_dir, exist_ok=True)
+                stored = [
+                    np.lib.format.open_memmap(
+                        os.path.join(embeddings_dir, f"{name}.npy"),
+                        mode="w+",
+                        dtype=np.float16,
+                        shape=(num_rows, embeddings.shape[1]),
+                    )
+                    for name in names
+                ]
+            stored[0][start:end] = batch_1
+            stored[1][start:end] = batch_2
+    if stored is not None:
+        for arr in stored:
+            arr.flush()
+    # Once per run, not per batch, as it writes the whole store
+    embedder.flush()
+    return scores
+
+
+def calculate_query_product_similarity(
+    df: pd.DataFrame,
+    query_col: str,
+    product_index: ProductEmbeddingIndex,
+    product_id_col: str = "product_id",
+    embedder: Optional[TextEmbedder] = None,
+) -> np.ndarray:
+    """
+    Cosine similarity of each query with its product's indexed text
+    Only the queries are embedded, product rows are gathered by id
+    Products missing from the index get nan
+    """
+    embedder = embedder or text_embedder
+    rows = product_index.lookup(df[product_id_col].values)
+    indexed = rows >= 0
+    scores = np.full(len(df), np.nan, dtype=np.float32)
+    if indexed.any():
+        queries = embedder.embed(df[query_col].values[indexed], normalise=True)
+        embedder.flush()
+        products = product_index.get(rows[indexed])
+        scores[indexed] = get_normalised_cosine_similarity(queries, products)
+    return scores
+
+
 def get_timestamp_part(
     timestamp_str: str,
     timestamp_part: str,
@@ -66,14 +212,63 @@ def calc_timestamp_part(
     Calculate the desired timestamp part
     Return results as a numpy array
     """
-    return (
-        df[timestamp_col]
-        .apply(
-            lambda x: get_timestamp_part(
-                timestamp_str=x,
-                timestamp_part=timestamp_part,
-                timestamp_format=timestamp_format,
-            )
-        )
-        .values
+    return calc_timestamp_parts(
+        df,
+        [timestamp_part],
+        timestamp_format=timestamp_format,
+        timestamp_col=timestamp_col,
+    )[:, 0]
+
+
+def parse_timestamps(
+    values: pd.Series, timestamp_format: str = "%Y-%m-%d %H:%M:%S"
+) -> pd.DatetimeIndex:
+    """
+    Vectorized parse with a fixed format
+    Each distinct string is only parsed once, as timestamps repeat for
+    every impression in a query
+    Already parsed datetime columns are returned as they are
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return pd.DatetimeIndex(values)
+    return pd.DatetimeIndex(
+        pd.to_datetime(values, format=timestamp_format, cache=True)
     )
+
+
+def calc_timestamp_parts(
+    df: pd.DataFrame,
+    timestamp_parts: List[str],
+    timestamp_format: str = "%Y-%m-%d %H:%M:%S",
+    timestamp_col: str = "local_timestamp",
+    cyclical: bool = False,
+) -> np.ndarray:
+    """
+    Calculate several timestamp parts, parsing the timestamps once
+    Returns a (num rows x num parts) array, in the order of timestamp_parts
+    With cyclical, each part is followed by its sin and cos encoding,
+    so eg. hour 23 is close to hour 0
+    To reuse the parse across calls, assign parse_timestamps back to the
+    column first
+    """
+    timestamps = parse_timestamps(df[timestamp_col], timestamp_format)
+    columns = []
+    for part in timestamp_parts:
+        values = getattr(timestamps, part).to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        columns.append(values)
+        if cyclical:
+            if part not in CYCLICAL_PERIODS:
+                raise ValueError(
+                    f"Cyclical parts must be in {list(CYCLICAL_PERIODS)}, "
+                    f"got {part}"
+                )
+            start, period = CYCLICAL_PERIODS[part]
+            angle = 2 * np.pi * (values - start) / period
+            columns.extend([np.sin(angle), np.cos(angle)])
+    block = np.column_stack(columns) if columns else np.empty((len(df), 0))
+    # Parts are whole numbers, unless encoded or missing
+    if not cyclical and not np.isnan(block).any():
+        block = block.astype(np.int64)
+    return block
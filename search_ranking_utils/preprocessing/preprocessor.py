@@ -1,43 +1,387 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+from concurrent.futures import Executor, ProcessPoolExecutor
+import logging
+import os
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from search_ranking_utils.utils.schema import Schema
-from search_ranking_utils.preprocessing.data_preprocessing import (
-    impute_df,
-    normalise_numerical_features,
-    map_oov_categories,
-    create_one_hot_encoder,
-    drop_cols,
-    one_hot_encode_categorical_features,
+from search_ranking_utils.utils.files import load_json, save_json
+from search_ranking_utils.utils.shared_memory import (
+    MemmapArraySpec,
+    SharedArrays,
+    SharedArraySpec,
+    get_num_jobs,
 )
+from search_ranking_utils.preprocessing.transform_plan import (
+    TransformPlan,
+    HashedStep,
+)
+
+logger = logging.getLogger(__name__)
+
+# Fitted plan of a worker process, set once by _init_worker
+_worker_plan: Optional[TransformPlan] = None
+
+
+def _to_json_value(value: Any) -> Any:
+    """
+    numpy scalars, eg. the mode of an int column, as python values
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _init_worker(plan: TransformPlan) -> None:
+    global _worker_plan
+    _worker_plan = plan
+
+
+def _transform_partition(
+    out_spec: Union[SharedArraySpec, MemmapArraySpec],
+    row_start: int,
+    partition: pd.DataFrame,
+    plan: Optional[TransformPlan] = None,
+) -> None:
+    """
+    Runs in a worker, writing the partition's rows into the shared output
+    Uses the worker's plan unless one is passed in
+    """
+    plan = plan or _worker_plan
+    shm, out = out_spec.attach()
+    try:
+        row_end = row_start + len(partition)
+        plan.transform(partition, dtype=out.dtype, out=out[row_start:row_end])
+        if isinstance(out, np.memmap):
+            out.flush()
+    finally:
+        # Views must be released before the block can be closed
+        del out
+        if shm is not None:
+            shm.close()
 
 
 class Preprocessor:
     """
     Combine all preprocessing steps that are relevant to the schema
-    A dataframe is also needed to learn the preprocessing values
+    Fitting learns the schema stats from a dataframe, which isn't kept
+    The schema is compiled into a TransformPlan which does the work
+    So the fitted state is only O(vocab size)
     """
 
-    def __init__(self, base_df: pd.DataFrame, schema: Schema):
-        self.base_df = base_df
+    VALID_SHARD_FORMATS = ["parquet", "npy"]
+    # Increment when the saved artifact layout changes
+    ARTIFACT_VERSION = 1
+
+    def __init__(self, base_df: Optional[pd.DataFrame], schema: Schema):
+        """
+        Stats already set on the schema are used as they are, eg. from
+        set_stats, the streaming stats builder or when loading
+        Otherwise the preprocessor is fit to base_df, if it is given
+        Call fit to explicitly refit
+        """
         self.schema = schema
+        self._plan = None
+        if self.schema.imputations is not None:
+            self._plan = TransformPlan.create_instance_from_schema(self.schema)
+        elif base_df is not None:
+            self.fit(base_df)
+
+    def fit(self, df: pd.DataFrame) -> "Preprocessor":
+        """
+        Set the schema stats from df and compile them into the plan
+        No reference to df is kept
+        """
+        self.schema.set_stats(df)
+        self._plan = TransformPlan.create_instance_from_schema(self.schema)
+        return self
+
+    @property
+    def plan(self) -> TransformPlan:
+        if self._plan is None:
+            raise NotImplementedError("Must fit the preprocessor first")
+        return self._plan
 
-        # Optional Preprocessing objs
-        if len(self.schema.categorical_features) > 0:
-            self.base_df = map_oov_categories(self.base_df, self.schema)
-            self.one_hot_encoder = create_one_hot_encoder(
-                self.base_df, self.schema
+    @property
+    def feature_names(self) -> List[str]:
+        return self.plan.feature_names
+
+    def transform_array(
+        self, df: pd.DataFrame, dtype: np.dtype = np.float32
+    ) -> np.ndarray:
+        """
+        Model features as one contiguous matrix
+        Columns are in the order of schema.get_model_features()
+        """
+        return self.plan.transform(df, dtype=dtype)
+
+    def transform_records(
+        self,
+        records: Union[List[Dict[str, Any]], Dict[str, List[Any]]],
+        dtype: np.dtype = np.float32,
+    ) -> np.ndarray:
+        """
+        Model features for a few raw records without using pandas
+        eg. one query's candidate products at serving time
+        Same matrix as transform_array
+        """
+        return self.plan.transform_records(records, dtype=dtype)
+
+    def transform_parallel(
+        self,
+        df: pd.DataFrame,
+        n_jobs: int,
+        dtype: np.dtype = np.float32,
+        executor: Optional[Executor] = None,
+        out: Optional[np.memmap] = None,
+    ) -> np.ndarray:
+        """
+        Same matrix as transform_array, with rows split over worker processes
+        n_jobs=-1 uses one worker per CPU
+        Each worker gets the fitted plan once, then only its input columns
+        Rows are written straight into a shared memory matrix, so results
+        are never pickled back, but are copied out of shared memory
+        For very large inputs, pass out, a memory mapped file such as from
+        np.lib.format.open_memmap, which workers write straight into
+        Then there is no copy, out is returned and dtype is out's dtype
+        A supplied executor is sent the plan with every partition instead
+        """
+        n_jobs = get_num_jobs(n_jobs)
+        if out is not None:
+            out_spec = MemmapArraySpec.create_instance_from_memmap(out)
+            dtype = out.dtype
+        if n_jobs == 1 and executor is None:
+            return self.plan.transform(df, dtype=dtype, out=out)
+        shape = (len(df), len(self.feature_names))
+        if out is not None and out.shape != shape:
+            raise ValueError(f"out must have shape {shape}, got {out.shape}")
+        bounds = np.unique(
+            np.linspace(0, len(df), n_jobs + 1).astype(np.int64)
+        )
+        inputs = df[self.plan.input_features]
+        logger.info(f"Transforming {len(df)} rows in {len(bounds) - 1} parts")
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=(self.plan,),
             )
-        else:
-            self.one_hot_encoder = None
+        # Only a supplied executor's workers don't already have the plan
+        plan = None if own_executor else self.plan
+        try:
+            with SharedArrays() as shared:
+                if out is None:
+                    shared.allocate("out", shape, dtype)
+                    out_spec = shared.specs["out"]
+                futures = [
+                    executor.submit(
+                        _transform_partition,
+                        out_spec,
+                        row_start,
+                        inputs.iloc[row_start:row_end],
+                        plan,
+                    )
+                    for row_start, row_end in zip(bounds[:-1], bounds[1:])
+                ]
+                for future in futures:
+                    future.result()
+                if out is None:
+                    # Copy out before the shared block is freed
+                    return shared.arrays["out"].copy()
+        finally:
+            if own_executor:
+                executor.shutdown()
+        # Workers wrote through their own maps of the file
+        out.flush()
+        return out
 
-    def __call__(
-        self, df: pd.DataFrame, drop_redundant: bool = True
+    def transform_sparse(
+        self, df: pd.DataFrame, dtype: np.dtype = np.float32
+    ) -> sparse.csr_matrix:
+        """
+        Model features as a CSR matrix, for high cardinality categories
+        Columns are in the order of schema.get_model_features()
+        """
+        return self.plan.transform_sparse(df, dtype=dtype)
+
+    def transform(
+        self,
+        df: pd.DataFrame,
+        drop_redundant: bool = True,
+        sparse_output: bool = False,
     ) -> pd.DataFrame:
+        """
+        DataFrame of the transformed matrix, in the original column order
+        Numerical features stay in place, categorical features are dropped
+        and their one hot columns are appended
+        Keeps the target and query col, or all columns if not dropping
+        redundant columns, any of them in schema.imputations are imputed
+        Uses float64 so values are the same as each individual step
+        With sparse_output, feature columns are pandas sparse columns
+        """
         if drop_redundant:
-            df = drop_cols(df, self.schema)
-        df = impute_df(df, self.schema.imputations)
-        if len(self.schema.numerical_features) > 0:
-            df = normalise_numerical_features(df, self.schema.norm_stats)
-        if self.one_hot_encoder:
-            df = map_oov_categories(df, self.schema)
-            df = one_hot_encode_categorical_features(df, self.one_hot_encoder)
-        return df
+            columns = self.schema.get_columns()
+        else:
+            columns = list(df.columns)
+        numerical_names = [step.name for step in self.plan.numerical_steps]
+        categorical_names = [step.name for step in self.plan.categorical_steps]
+        columns = [c for c in columns if c not in categorical_names]
+        kept_cols = [c for c in columns if c not in numerical_names]
+        kept = df[kept_cols]
+        imputations = {
+            c: v for c, v in self.schema.imputations.items() if c in kept_cols
+        }
+        if imputations:
+            kept = kept.fillna(imputations)
+        if sparse_output:
+            arr = self.transform_sparse(df, dtype=np.float64)
+        else:
+            arr = self.transform_array(df, dtype=np.float64)
+        features = self.plan.to_frame(arr, index=df.index)
+        encoded_cols = features.columns.drop(numerical_names).tolist()
+        return pd.concat([kept, features], axis=1)[columns + encoded_cols]
+
+    def __call__(self, df: pd.DataFrame, **kwargs) -> pd.DataFrame:
+        """
+        Same as transform
+        """
+        return self.transform(df, **kwargs)
+
+    def transform_chunks(
+        self, chunks: Iterable[pd.DataFrame], **kwargs
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Lazily preprocess chunks, eg. from pd.read_csv(chunksize=...)
+        Every row is transformed independently, so the concatenated output
+        is identical to calling the preprocessor on all the data at once
+        Peak memory is bounded by the chunk size
+        """
+        for chunk in chunks:
+            yield self(chunk, **kwargs)
+
+    def write_chunks(
+        self,
+        chunks: Iterable[pd.DataFrame],
+        output_dir: str,
+        shard_format: str = "parquet",
+    ) -> List[str]:
+        """
+        Preprocess chunks and write each one to its own shard
+        parquet shards hold the same DataFrame as calling the preprocessor
+        npy shards hold the float32 feature matrix and the target
+        Returns the paths written
+        """
+        if shard_format not in self.VALID_SHARD_FORMATS:
+            raise ValueError(
+                f"shard_format must be in {self.VALID_SHARD_FORMATS}, "
+                f"got {shard_format}"
+            )
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for i, chunk in enumerate(chunks):
+            if shard_format == "parquet":
+                path = os.path.join(output_dir, f"part-{i:05d}.parquet")
+                self(chunk).to_parquet(path)
+                paths.append(path)
+            else:
+                features_path = os.path.join(
+                    output_dir, f"features-{i:05d}.npy"
+                )
+                target_path = os.path.join(output_dir, f"target-{i:05d}.npy")
+                np.save(features_path, self.transform_array(chunk))
+                np.save(target_path, chunk[self.schema.target].to_numpy())
+                paths.extend([features_path, target_path])
+            logger.info(f"Wrote shard {i} with {len(chunk)} rows")
+        return paths
+
+    def save(self, path: str) -> None:
+        """
+        Save the fitted schema and preprocessor to a directory
+        Stats and vocabs are .npy arrays, vocabs keep their dtype
+        Nothing is pickled, so loading doesn't need the training data
+        """
+        os.makedirs(path, exist_ok=True)
+        numerical_stats = np.array(
+            [
+                [step.impute_val, step.mean, step.std]
+                for step in self.plan.numerical_steps
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        np.save(
+            os.path.join(path, "numerical_stats.npy"),
+            numerical_stats,
+            allow_pickle=False,
+        )
+        for i, step in enumerate(self.plan.categorical_steps):
+            # Hashed features have no vocab
+            if isinstance(step, HashedStep):
+                continue
+            vocab = np.asarray(step.categories)
+            # Mixed types would be cast, eg. ints to strings
+            if vocab.dtype == object or vocab.tolist() != step.categories:
+                raise ValueError(
+                    f"Vocab of {step.name} must have a single type to save"
+                )
+            np.save(
+                os.path.join(path, f"vocab_{i}.npy"),
+                vocab,
+                allow_pickle=False,
+            )
+        save_json(
+            {
+                "version": self.ARTIFACT_VERSION,
+                "schema": self.schema.to_dict(),
+                # Raw std, the plan replaces a std of 0 with epsilon
+                "stds": [
+                    self.schema.norm_stats[step.name]["std"]
+                    for step in self.plan.numerical_steps
+                ],
+                "categorical_imputations": [
+                    _to_json_value(self.schema.imputations[step.name])
+                    for step in self.plan.categorical_steps
+                ],
+                "feature_names": self.feature_names,
+            },
+            os.path.join(path, "metadata.json"),
+        )
+        logger.info(f"Saved preprocessor to {path}")
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load a preprocessor saved with save, including its schema stats
+        """
+        metadata = load_json(os.path.join(path, "metadata.json"))
+        if metadata["version"] != cls.ARTIFACT_VERSION:
+            raise ValueError(
+                f"Artifact version {metadata['version']} is not supported, "
+                f"expected {cls.ARTIFACT_VERSION}"
+            )
+        schema = Schema.create_instance_from_dict(metadata["schema"])
+        numerical_stats = np.load(os.path.join(path, "numerical_stats.npy"))
+        schema.imputations = {}
+        schema.norm_stats = {}
+        for f, f_stats, std in zip(
+            schema.numerical_features, numerical_stats, metadata["stds"]
+        ):
+            schema.imputations[f.name] = float(f_stats[0])
+            schema.norm_stats[f.name] = {"mean": float(f_stats[1]), "std": std}
+        schema.vocabs = {}
+        for i, (f, impute_val) in enumerate(
+            zip(
+                schema.categorical_features,
+                metadata["categorical_imputations"],
+            )
+        ):
+            schema.imputations[f.name] = impute_val
+            if f.hash_buckets:
+                continue
+            # Python values, so they match the raw values being looked up
+            schema.vocabs[f.name] = np.load(
+                os.path.join(path, f"vocab_{i}.npy")
+            ).tolist()
+        preprocessor = cls(None, schema)
+        if preprocessor.feature_names != metadata["feature_names"]:
+            raise ValueError("Loaded features don't match the saved features")
+        return preprocessor
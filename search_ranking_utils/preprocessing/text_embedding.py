@@ -0,0 +1,507 @@
+from typing import Any, Callable, Dict, List, Optional, Union
+from collections import OrderedDict
+import logging
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def hash_texts(texts: Union[np.ndarray, List[str]]) -> np.ndarray:
+    """
+    Stable 64 bit hash of each text, the same across runs and processes
+    """
+    return pd.util.hash_array(np.asarray(texts, dtype=object))
+
+
+def normalise_rows(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Scale each row to unit length, zero rows are left as zeros
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
+
+
+class EmbeddingCache:
+    """
+    Bounded in-process LRU cache of text -> embedding
+    The least recently used texts are dropped once max_size is reached
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.embeddings: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        embedding = self.embeddings.get(text)
+        if embedding is not None:
+            self.embeddings.move_to_end(text)
+        return embedding
+
+    def put(self, text: str, embedding: np.ndarray) -> None:
+        self.embeddings[text] = embedding
+        self.embeddings.move_to_end(text)
+        if len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+
+class EmbeddingStore:
+    """
+    Embeddings on disk, as a memory mapped (capacity x dim) .npy matrix
+    Rows are found by uint64 key, eg. a text hash, through a hash index
+    of the keys, so only the rows that are used are paged in
+    Capacity doubles when full, so appending is amortised O(1) per row
+    New keys are kept in a dict until there are as many as in the index,
+    so the index is rebuilt in amortised O(1) per key too
+    Changes are only written to disk by flush
+    """
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    KEYS_FILE = "keys.npy"
+
+    def __init__(
+        self,
+        path: str,
+        dim: Optional[int] = None,
+        dtype: np.dtype = np.float32,
+        initial_capacity: int = 1024,
+    ):
+        """
+        Opens the store at path if there is one, otherwise creates it
+        dim is only needed to create a store
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+        embeddings_path = os.path.join(path, self.EMBEDDINGS_FILE)
+        keys_path = os.path.join(path, self.KEYS_FILE)
+        if self.exists(path):
+            self.embeddings = np.load(embeddings_path, mmap_mode="r+")
+            if dim is not None and self.embeddings.shape[1] != dim:
+                raise ValueError(
+                    f"Store has dim {self.embeddings.shape[1]}, expected {dim}"
+                )
+            self.dim = self.embeddings.shape[1]
+            self.dtype = self.embeddings.dtype
+            keys = np.load(keys_path)
+        else:
+            if dim is None:
+                raise ValueError(f"No store at {path}, dim is needed")
+            self.dim = dim
+            self.embeddings = np.lib.format.open_memmap(
+                embeddings_path,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(initial_capacity, dim),
+            )
+            keys = np.empty(0, dtype=np.uint64)
+            np.save(keys_path, keys)
+        self.index = pd.Index(keys)
+        # Key to row of keys added since the index was built
+        self.new_rows: Dict[int, int] = {}
+        self.is_flushed = True
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """
+        Only flushed stores can be opened
+        """
+        return os.path.exists(os.path.join(path, cls.KEYS_FILE))
+
+    def __len__(self) -> int:
+        return len(self.index) + len(self.new_rows)
+
+    @property
+    def keys(self) -> np.ndarray:
+        # Dicts keep insertion order, which is row order
+        new_keys = np.fromiter(
+            self.new_rows, dtype=np.uint64, count=len(self.new_rows)
+        )
+        return np.concatenate([self.index.to_numpy(), new_keys])
+
+    def _rebuild_index(self) -> None:
+        self.index = pd.Index(self.keys)
+        self.new_rows = {}
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Row of each key, -1 if it isn't stored
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = self.index.get_indexer(keys)
+        if self.new_rows:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self.new_rows.get(int(keys[i]), -1)
+        return rows
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(self.embeddings[rows])
+
+    def _grow(self, num_rows: int) -> None:
+        capacity = len(self.embeddings)
+        while capacity < num_rows:
+            capacity *= 2
+        if capacity == len(self.embeddings):
+            return
+        embeddings_path = os.path.join(self.path, self.EMBEDDINGS_FILE)
+        tmp_path = embeddings_path + ".tmp"
+        grown = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=self.dtype, shape=(capacity, self.dim)
+        )
+        grown[: len(self)] = self.embeddings[: len(self)]
+        grown.flush()
+        del grown
+        self.embeddings = None
+        os.replace(tmp_path, embeddings_path)
+        self.embeddings = np.load(embeddings_path, mmap_mode="r+")
+
+    def put(self, keys: np.ndarray, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Overwrite the rows of existing keys and append new keys
+        Keys should be unique, returns the row of each key
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = self.lookup(keys)
+        new = rows < 0
+        num_stored = len(self)
+        rows[new] = np.arange(num_stored, num_stored + new.sum())
+        self._grow(num_stored + new.sum())
+        self.embeddings[rows] = embeddings
+        self.new_rows.update(zip(keys[new].tolist(), rows[new].tolist()))
+        if len(self.new_rows) > len(self.index):
+            self._rebuild_index()
+        self.is_flushed = False
+        return rows
+
+    def flush(self) -> None:
+        """
+        Write the embeddings and keys, O(store size) so call it once
+        after a run of puts, not after each one
+        """
+        if self.is_flushed:
+            return
+        self.embeddings.flush()
+        np.save(os.path.join(self.path, self.KEYS_FILE), self.keys)
+        self.is_flushed = True
+
+
+class PipelinedEncoder:
+    """
+    Overlap tokenization with inference, for CPU only hosts
+    Texts are sorted by length and batched, so each batch pads little
+    A tokenizer thread fills a queue of at most queue_depth batches,
+    which num_workers inference threads take from
+    Tokenizers and torch release the GIL, so the threads run in parallel
+    Has the same encode method as a SentenceTransformer
+    """
+
+    # Tells an inference worker there are no more batches
+    _DONE = None
+
+    def __init__(
+        self,
+        tokenize_fn: Callable[[List[str]], Any],
+        infer_fn: Callable[[Any], np.ndarray],
+        num_workers: int = 2,
+        queue_depth: int = 4,
+        batch_size: int = 32,
+    ):
+        self.tokenize_fn = tokenize_fn
+        self.infer_fn = infer_fn
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+
+    @classmethod
+    def create_instance_from_sentence_transformer(
+        cls,
+        model: Any,
+        num_workers: int = 2,
+        queue_depth: int = 4,
+        batch_size: int = 32,
+        threads_per_worker: Optional[int] = None,
+    ):
+        """
+        threads_per_worker sets torch's intra-op threads, which is global
+        eg. cpu count // num_workers to avoid oversubscribing cores
+        """
+        import torch
+
+        if threads_per_worker is not None:
+            torch.set_num_threads(threads_per_worker)
+
+        def infer(features: dict) -> np.ndarray:
+            with torch.inference_mode():
+                embeddings = model(features)["sentence_embedding"]
+            return embeddings.float().cpu().numpy()
+
+        return cls(model.tokenize, infer, num_workers, queue_depth, batch_size)
+
+    def _get_batches(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Positions of the texts in each batch, shortest texts first
+        """
+        order = np.argsort([len(str(t)) for t in texts], kind="stable")
+        num_batches = int(np.ceil(len(texts) / self.batch_size))
+        return np.array_split(order, num_batches)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        texts = list(texts)
+        if len(texts) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        batches = self._get_batches(texts)
+        tokenized = queue.Queue(maxsize=self.queue_depth)
+        results: Dict[int, np.ndarray] = {}
+        errors: List[Exception] = []
+
+        def tokenize() -> None:
+            try:
+                for i, batch in enumerate(batches):
+                    if errors:
+                        break
+                    batch_texts = [texts[j] for j in batch]
+                    tokenized.put((i, self.tokenize_fn(batch_texts)))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for _ in range(self.num_workers):
+                    tokenized.put(self._DONE)
+
+        def infer() -> None:
+            # Keeps taking batches after an error so tokenize never blocks
+            while (item := tokenized.get()) is not self._DONE:
+                if errors:
+                    continue
+                i, features = item
+                try:
+                    results[i] = np.asarray(self.infer_fn(features))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=tokenize)] + [
+            threading.Thread(target=infer) for _ in range(self.num_workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        # Scatter back to the original order
+        embeddings = np.empty(
+            (len(texts), results[0].shape[1]), dtype=results[0].dtype
+        )
+        for i, batch in enumerate(batches):
+            embeddings[batch] = results[i]
+        return embeddings
+
+
+class TextEmbedder:
+    """
+    Embed texts, only running the encoder on texts it hasn't seen
+    Texts are deduplicated, then looked up in the LRU cache, then the
+    optional on-disk store, and only the rest are encoded
+    The encoder needs an encode(List[str]) -> np.ndarray method,
+    eg. a SentenceTransformer
+    Without an encoder, the model_name SentenceTransformer is loaded on
+    first use, so creating an embedder costs nothing
+    Use num_workers to overlap tokenization and inference
+    """
+
+    def __init__(
+        self,
+        encoder: Optional[Any] = None,
+        model_name: Optional[str] = None,
+        cache_size: int = 100000,
+        store: Optional[EmbeddingStore] = None,
+        num_workers: int = 0,
+        **pipeline_kwargs,
+    ):
+        """
+        With num_workers, the loaded model is wrapped in a
+        PipelinedEncoder, pipeline_kwargs are passed on to it
+        """
+        if encoder is None and model_name is None:
+            raise ValueError("Must give an encoder or a model_name")
+        self._encoder = encoder
+        self.model_name = model_name
+        self.cache = EmbeddingCache(cache_size)
+        self.store = store
+        self.num_workers = num_workers
+        self.pipeline_kwargs = pipeline_kwargs
+
+    @property
+    def encoder(self) -> Any:
+        if self._encoder is None:
+            # Imported here so torch is only loaded when embedding
+            from sentence_transformers import SentenceTransformer
+
+            logger.info(f"Loading embedding model {self.model_name}")
+            self._encoder = SentenceTransformer(self.model_name)
+            if self.num_workers > 0:
+                self._encoder = (
+                    PipelinedEncoder.create_instance_from_sentence_transformer(
+                        self._encoder,
+                        num_workers=self.num_workers,
+                        **self.pipeline_kwargs,
+                    )
+                )
+        return self._encoder
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._encoder is not None
+
+    def warm_up(self) -> None:
+        """
+        Load the model and run it once, eg. before serving traffic
+        Nothing is cached, so embeddings are unchanged
+        """
+        self._encode(["warm up"])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.encoder.encode(texts), dtype=np.float32)
+
+    def _embed_unique(self, texts: np.ndarray) -> np.ndarray:
+        found: Dict[int, np.ndarray] = {}
+        for i, text in enumerate(texts):
+            embedding = self.cache.get(text)
+            if embedding is not None:
+                found[i] = embedding
+        missing = np.array(
+            [i for i in range(len(texts)) if i not in found], dtype=np.int64
+        )
+        if self.store is not None and len(missing) > 0:
+            rows = self.store.lookup(hash_texts(texts[missing]))
+            in_store = rows >= 0
+            stored = self.store.get(rows[in_store]).astype(np.float32)
+            for i, embedding in zip(missing[in_store], stored):
+                found[i] = embedding
+                self.cache.put(texts[i], embedding)
+            missing = missing[~in_store]
+        if len(missing) > 0:
+            logger.info(f"Encoding {len(missing)} of {len(texts)} texts")
+            encoded = self._encode(list(texts[missing]))
+            for i, embedding in zip(missing, encoded):
+                found[i] = embedding
+                self.cache.put(texts[i], embedding)
+            if self.store is not None:
+                self.store.put(hash_texts(texts[missing]), encoded)
+        return np.stack([found[i] for i in range(len(texts))])
+
+    def flush(self) -> None:
+        """
+        Write new embeddings to the store, if there is one
+        """
+        if self.store is not None:
+            self.store.flush()
+
+    def embed(
+        self, texts: Union[np.ndarray, List[str]], normalise: bool = False
+    ) -> np.ndarray:
+        """
+        (num texts x dim) embeddings, each distinct text is embedded once
+        and scattered back to every row it appears in
+        New embeddings are only written to the store by flush
+        With normalise, rows have unit length so dot products are cosines
+        Only the distinct embeddings are normalised
+        """
+        codes, uniques = pd.factorize(
+            np.asarray(texts, dtype=object), use_na_sentinel=False
+        )
+        if len(uniques) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        embeddings = self._embed_unique(np.asarray(uniques, dtype=object))
+        if normalise:
+            embeddings = normalise_rows(embeddings)
+        return embeddings[codes]
+
+
+class ProductEmbeddingIndex:
+    """
+    Normalised product text embeddings keyed by product id, on disk
+    Built once, then only new products, or ones whose text changed, are
+    embedded on update
+    Similarity features then only need to embed queries and gather
+    product rows by index
+    """
+
+    TEXT_HASHES_FILE = "text_hashes.npy"
+
+    def __init__(
+        self,
+        path: str,
+        embedder: TextEmbedder,
+        dtype: np.dtype = np.float32,
+    ):
+        self.path = path
+        self.embedder = embedder
+        self.dtype = dtype
+        self.store = None
+        # Hash of the text embedded in each row, to spot changes
+        self.text_hashes = np.empty(0, dtype=np.uint64)
+        if EmbeddingStore.exists(path):
+            self.store = EmbeddingStore(path)
+            self.text_hashes = np.load(
+                os.path.join(path, self.TEXT_HASHES_FILE)
+            )
+
+    def __len__(self) -> int:
+        return 0 if self.store is None else len(self.store)
+
+    def lookup(self, product_ids: Union[np.ndarray, List[Any]]) -> np.ndarray:
+        """
+        Row of each product, -1 if it isn't indexed
+        """
+        if self.store is None:
+            return np.full(len(product_ids), -1, dtype=np.int64)
+        return self.store.lookup(hash_texts(product_ids))
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        return self.store.get(rows).astype(np.float32)
+
+    def update(
+        self,
+        product_ids: Union[np.ndarray, List[Any]],
+        texts: Union[np.ndarray, List[str]],
+    ) -> int:
+        """
+        Embed and store new or changed products, returns how many
+        The last text is used for repeated ids
+        """
+        products = pd.Series(
+            np.asarray(texts, dtype=object), index=product_ids
+        )
+        products = products[~products.index.duplicated(keep="last")]
+        keys = hash_texts(products.index)
+        text_hashes = hash_texts(products.values)
+        rows = self.lookup(products.index)
+        stale = rows < 0
+        stale[~stale] = self.text_hashes[rows[~stale]] != text_hashes[~stale]
+        if not stale.any():
+            return 0
+        embeddings = self.embedder.embed(
+            products.values[stale], normalise=True
+        )
+        if self.store is None:
+            self.store = EmbeddingStore(
+                self.path, embeddings.shape[1], self.dtype
+            )
+        rows = self.store.put(keys[stale], embeddings)
+        num_new = len(self.store) - len(self.text_hashes)
+        self.text_hashes = np.concatenate(
+            [self.text_hashes, np.zeros(num_new, dtype=np.uint64)]
+        )
+        self.text_hashes[rows] = text_hashes[stale]
+        self.store.flush()
+        np.save(
+            os.path.join(self.path, self.TEXT_HASHES_FILE), self.text_hashes
+        )
+        logger.info(f"Indexed {stale.sum()} new or changed products")
+        return int(stale.sum())
@@ -0,0 +1,325 @@
+from typing import Any, Dict, List, Optional, Union
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from search_ranking_utils.utils.schema import Schema, CategoricalFeature
+from search_ranking_utils.preprocessing.data_preprocessing import (
+    create_vocab_dtype,
+    get_category_codes,
+    hash_categories,
+)
+
+
+def _is_null(value: Any) -> bool:
+    # NaN is the only value not equal to itself
+    return value is None or value != value
+
+
+@dataclass
+class NumericalStep:
+    """
+    Impute and normalise one numerical feature into one column
+    """
+
+    name: str
+    column: int
+    impute_val: float
+    mean: float
+    std: float
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray:
+        return self.transform_values(
+            df[self.name].to_numpy(dtype=np.float64, na_value=np.nan)
+        )
+
+    def transform_values(self, values: Union[np.ndarray, list]) -> np.ndarray:
+        """
+        Works on raw values too, None is treated as null
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = np.where(np.isnan(values), self.impute_val, values)
+        return (values - self.mean) / self.std
+
+
+@dataclass
+class CategoricalStep:
+    """
+    Impute and one hot encode one categorical feature
+    Category i is written to column start + i
+    Unknown categories go to oov_index, or no column if it is None
+    """
+
+    name: str
+    start: int
+    impute_val: str
+    categories: List[str]
+    oov_index: Optional[int]
+
+    def __post_init__(self):
+        # Built once so every transform is an array lookup
+        self.vocab_dtype = create_vocab_dtype(self.categories)
+        self.impute_code = get_category_codes(
+            pd.Series([self.impute_val]), self.vocab_dtype, self.oov_index
+        )[0]
+        # For single records, where pandas overhead dominates
+        self.category_index = {c: i for i, c in enumerate(self.categories)}
+
+    def get_codes(self, values: pd.Series) -> np.ndarray:
+        """
+        Position of each imputed value in the categories, -1 if unknown
+        The codes are both the OOV mapping and the one hot columns
+        """
+        codes = get_category_codes(values, self.vocab_dtype, self.oov_index)
+        codes[values.isna().to_numpy()] = self.impute_code
+        return codes
+
+    def get_record_codes(self, values: List[Any]) -> np.ndarray:
+        """
+        Same as get_codes for a list of raw values, using dict lookups
+        """
+        unknown_code = -1 if self.oov_index is None else self.oov_index
+        return np.array(
+            [
+                (
+                    self.impute_code
+                    if _is_null(value)
+                    else self.category_index.get(value, unknown_code)
+                )
+                for value in values
+            ],
+            dtype=np.int64,
+        )
+
+
+@dataclass
+class HashedStep:
+    """
+    Impute and hash one categorical feature into num_buckets columns
+    Stateless, so new categories never need refitting
+    Bucket i is written to column start + i
+    """
+
+    name: str
+    start: int
+    impute_val: str
+    num_buckets: int
+
+    def get_codes(self, values: pd.Series) -> np.ndarray:
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Hash each category once, eg. dictionary encoded columns
+            buckets = hash_categories(values.cat.categories, self.num_buckets)
+            impute_bucket = hash_categories(
+                [self.impute_val], self.num_buckets
+            )[0]
+            # Nulls are code -1, the last bucket, even with no categories
+            buckets = np.append(buckets, impute_bucket)
+            return buckets[values.cat.codes.to_numpy()]
+        return hash_categories(
+            values.fillna(self.impute_val), self.num_buckets
+        )
+
+    def get_record_codes(self, values: List[Any]) -> np.ndarray:
+        """
+        Same as get_codes for a list of raw values
+        """
+        return hash_categories(
+            [
+                self.impute_val if _is_null(value) else value
+                for value in values
+            ],
+            self.num_buckets,
+        )
+
+
+class TransformPlan:
+    """
+    The schema's preprocessing compiled into per feature steps
+    Imputed, normalised and one hot values are written straight into
+    one preallocated matrix, without intermediate copies of the df
+    Column order matches schema.get_model_features()
+    """
+
+    def __init__(
+        self,
+        numerical_steps: List[NumericalStep],
+        categorical_steps: List[Union[CategoricalStep, HashedStep]],
+        feature_names: List[str],
+    ):
+        self.numerical_steps = numerical_steps
+        self.categorical_steps = categorical_steps
+        self.feature_names = feature_names
+
+    @property
+    def input_features(self) -> List[str]:
+        return [step.name for step in self.numerical_steps] + [
+            step.name for step in self.categorical_steps
+        ]
+
+    @classmethod
+    def create_instance_from_schema(
+        cls, schema: Schema, epsilon: float = 1e-8
+    ):
+        """
+        Requires the schema stats already set
+        The `epsilon` param is to prevent zero division
+        """
+        feature_names = schema.get_model_features()
+        numerical_steps = []
+        for column, f in enumerate(schema.numerical_features):
+            f_stats = schema.norm_stats[f.name]
+            numerical_steps.append(
+                NumericalStep(
+                    name=f.name,
+                    column=column,
+                    impute_val=schema.imputations[f.name],
+                    mean=f_stats["mean"],
+                    std=epsilon if f_stats["std"] == 0 else f_stats["std"],
+                )
+            )
+        categorical_steps = []
+        start = len(numerical_steps)
+        for f in schema.categorical_features:
+            if f.hash_buckets:
+                categorical_steps.append(
+                    HashedStep(
+                        name=f.name,
+                        start=start,
+                        impute_val=schema.imputations[f.name],
+                        num_buckets=f.hash_buckets,
+                    )
+                )
+                start += f.hash_buckets
+                continue
+            categories = list(schema.vocabs[f.name])
+            # Only capped features map unknown categories to OOV
+            oov_index = None
+            if f.max_categories and CategoricalFeature.DEFAULT_VAL in (
+                categories
+            ):
+                oov_index = categories.index(CategoricalFeature.DEFAULT_VAL)
+            categorical_steps.append(
+                CategoricalStep(
+                    name=f.name,
+                    start=start,
+                    impute_val=schema.imputations[f.name],
+                    categories=categories,
+                    oov_index=oov_index,
+                )
+            )
+            start += len(categories)
+        return cls(numerical_steps, categorical_steps, feature_names)
+
+    def transform(
+        self,
+        df: pd.DataFrame,
+        dtype: np.dtype = np.float32,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Fill a (num rows x num model features) matrix
+        Optionally write into an existing array
+        """
+        shape = (len(df), len(self.feature_names))
+        if out is None:
+            out = np.zeros(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(f"out must have shape {shape}, got {out.shape}")
+        else:
+            out[...] = 0
+        for step in self.numerical_steps:
+            out[:, step.column] = step.transform(df)
+        for step in self.categorical_steps:
+            codes = step.get_codes(df[step.name])
+            known = codes >= 0
+            out[np.flatnonzero(known), step.start + codes[known]] = 1
+        return out
+
+    def transform_records(
+        self,
+        records: Union[List[Dict[str, Any]], Dict[str, List[Any]]],
+        dtype: np.dtype = np.float32,
+    ) -> np.ndarray:
+        """
+        Same matrix as transform, without building a DataFrame
+        For scoring small requests, eg. one query's candidates at serving
+        records can be a list of dicts, or a dict of column lists
+        Missing keys and None are treated as null
+        """
+        if isinstance(records, dict):
+            # Other columns, eg. ids, may not be the same length
+            lengths = {
+                len(records[name])
+                for name in self.input_features
+                if name in records
+            }
+            if len(lengths) > 1:
+                raise ValueError(
+                    f"Feature columns must have the same length, "
+                    f"got {sorted(lengths)}"
+                )
+            num_rows = lengths.pop() if lengths else 0
+            columns = {
+                name: records.get(name, [None] * num_rows)
+                for name in self.input_features
+            }
+        else:
+            columns = {
+                name: [record.get(name) for record in records]
+                for name in self.input_features
+            }
+            num_rows = len(records)
+        out = np.zeros((num_rows, len(self.feature_names)), dtype=dtype)
+        for step in self.numerical_steps:
+            out[:, step.column] = step.transform_values(columns[step.name])
+        for step in self.categorical_steps:
+            codes = step.get_record_codes(columns[step.name])
+            known = codes >= 0
+            out[np.flatnonzero(known), step.start + codes[known]] = 1
+        return out
+
+    def transform_sparse(
+        self, df: pd.DataFrame, dtype: np.dtype = np.float32
+    ) -> sparse.csr_matrix:
+        """
+        Same matrix as transform, but only storing non-zeros
+        Numerical features are stored for every row, one hot only once
+        Memory scales with rows x features, not rows x categories
+        """
+        num_rows = len(df)
+        # Start with empty arrays so there is always something to concat
+        rows = [np.empty(0, dtype=np.int64)]
+        cols = [np.empty(0, dtype=np.int64)]
+        data = [np.empty(0)]
+        for step in self.numerical_steps:
+            rows.append(np.arange(num_rows))
+            cols.append(np.full(num_rows, step.column))
+            data.append(step.transform(df))
+        for step in self.categorical_steps:
+            codes = step.get_codes(df[step.name])
+            known = np.flatnonzero(codes >= 0)
+            rows.append(known)
+            cols.append(step.start + codes[known])
+            data.append(np.ones(len(known)))
+        return sparse.coo_matrix(
+            (
+                np.concatenate(data).astype(dtype),
+                (np.concatenate(rows), np.concatenate(cols)),
+            ),
+            shape=(num_rows, len(self.feature_names)),
+        ).tocsr()
+
+    def to_frame(
+        self, arr: np.ndarray, index: Optional[pd.Index] = None
+    ) -> pd.DataFrame:
+        """
+        Thin DataFrame view of a transformed matrix, the data isn't copied
+        Sparse matrices give a DataFrame of sparse columns
+        """
+        if sparse.issparse(arr):
+            return pd.DataFrame.sparse.from_spmatrix(
+                arr, index=index, columns=self.feature_names
+            )
+        return pd.DataFrame(
+            arr, columns=self.feature_names, index=index, copy=False
+        )
@@ -5,3 +5,8 @@ def load_json(filepath: str) -> dict:
     with open(filepath, "r") as f:
         json_dict = json.load(f)
     return json_dict
+
+
+def save_json(json_dict: dict, filepath: str) -> None:
+    with open(filepath, "w") as f:
+        json.dump(json_dict, f, indent=4)
@@ -0,0 +1,159 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from search_ranking_utils.utils.schema import Schema
+
+logger = logging.getLogger(__name__)
+
+# Either a pyarrow expression or DNF tuples, eg. [("day", ">=", 20240101)]
+Filters = Union[ds.Expression, List[Tuple], List[List[Tuple]]]
+
+VALID_FILE_FORMATS = ["parquet", "csv", "ipc", "feather", "arrow"]
+
+
+def _get_file_format(
+    schema: Schema, file_format: str
+) -> Union[ds.FileFormat, str]:
+    """
+    Parquet categoricals are read as dictionary arrays, so each
+    distinct string is only decoded once per row group
+    """
+    if file_format not in VALID_FILE_FORMATS:
+        raise ValueError(
+            f"file_format must be in {VALID_FILE_FORMATS}, got {file_format}"
+        )
+    if file_format == "parquet":
+        return ds.ParquetFileFormat(
+            read_options=ds.ParquetReadOptions(
+                dictionary_columns=[
+                    f.name for f in schema.categorical_features
+                ]
+            )
+        )
+    return file_format
+
+
+def _get_filter_expression(
+    filters: Optional[Filters],
+) -> Optional[ds.Expression]:
+    if filters is None or isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+
+def create_schema_dataset(
+    source: Union[str, List[str]],
+    schema: Schema,
+    file_format: str = "parquet",
+) -> ds.Dataset:
+    """
+    Lazy dataset over a file, directory (eg. hive partitioned) or file list
+    Nothing is read until it is scanned
+    """
+    return ds.dataset(
+        source,
+        format=_get_file_format(schema, file_format),
+        partitioning="hive",
+    )
+
+
+def _get_scan_columns(
+    schema: Schema, extra_cols: Optional[List[str]] = None
+) -> List[str]:
+    return schema.get_columns() + list(extra_cols or [])
+
+
+def _dictionary_encode(table: pa.Table, schema: Schema) -> pa.Table:
+    """
+    Formats other than parquet don't read dictionaries directly
+    """
+    for f in schema.categorical_features:
+        i = table.schema.get_field_index(f.name)
+        if not pa.types.is_dictionary(table.schema.field(i).type):
+            table = table.set_column(
+                i, f.name, table.column(i).dictionary_encode()
+            )
+    return table
+
+
+def _to_pandas(table: pa.Table, schema: Schema) -> pd.DataFrame:
+    """
+    Dictionary columns become pandas categoricals
+    Numerical columns without nulls are converted without copying
+    """
+    table = _dictionary_encode(table, schema)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_dataset(
+    source: Union[str, List[str]],
+    schema: Schema,
+    filters: Optional[Filters] = None,
+    extra_cols: Optional[List[str]] = None,
+    file_format: str = "parquet",
+) -> pd.DataFrame:
+    """
+    Read only the schema's columns, plus any extra_cols, as a DataFrame
+    filters are pushed down, so parquet row groups whose stats don't
+    match and hive partitions that don't match are never read
+    Categorical features are returned as pandas categoricals
+    """
+    dataset = create_schema_dataset(source, schema, file_format)
+    table = dataset.to_table(
+        columns=_get_scan_columns(schema, extra_cols),
+        filter=_get_filter_expression(filters),
+    )
+    logger.info(
+        f"Read {table.num_rows} rows, {table.nbytes / 1e6:.1f}MB from {source}"
+    )
+    return _to_pandas(table, schema)
+
+
+def iter_dataset_batches(
+    source: Union[str, List[str]],
+    schema: Schema,
+    filters: Optional[Filters] = None,
+    extra_cols: Optional[List[str]] = None,
+    file_format: str = "parquet",
+    batch_size: int = 131072,
+) -> Iterator[pd.DataFrame]:
+    """
+    Same as read_dataset, but yields DataFrames of at most batch_size rows
+    So it can be streamed through Preprocessor.transform_chunks,
+    set_stats_from_chunks or accumulate_metrics
+    Category codes mean the same in every batch, each batch's categories
+    are the ones seen so far, so later batches can only add categories
+    """
+    dataset = create_schema_dataset(source, schema, file_format)
+    batches = dataset.to_batches(
+        columns=_get_scan_columns(schema, extra_cols),
+        filter=_get_filter_expression(filters),
+        batch_size=batch_size,
+    )
+    seen_categories: Dict[str, pd.Index] = {}
+    for batch in batches:
+        df = _to_pandas(pa.Table.from_batches([batch]), schema)
+        _unify_categories(df, schema, seen_categories)
+        yield df
+
+
+def _unify_categories(
+    df: pd.DataFrame, schema: Schema, seen_categories: Dict[str, pd.Index]
+) -> None:
+    """
+    Each batch is dictionary encoded on its own, so the same code can
+    be a different category in each batch
+    New categories are appended to the ones seen, keeping existing codes
+    """
+    for f in schema.categorical_features:
+        values = df[f.name]
+        seen = seen_categories.get(f.name)
+        if seen is None:
+            seen_categories[f.name] = values.cat.categories
+            continue
+        new = values.cat.categories.difference(seen, sort=False)
+        seen_categories[f.name] = seen.append(new)
+        df[f.name] = values.cat.set_categories(seen_categories[f.name])
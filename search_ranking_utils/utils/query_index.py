@@ -0,0 +1,143 @@
+from typing import Optional
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
+
+
+class QueryIndex:
+    """
+    Group rows by query once, so the grouping can be reused
+    Rows are referred to by position, not by the df's index
+    Query i is made up of rows order[offsets[i]:offsets[i + 1]]
+    Queries are in sorted order, the same as a groupby
+    """
+
+    VALID_AGGREGATIONS = ["sum", "mean", "min", "max", "size"]
+
+    def __init__(
+        self,
+        order: np.ndarray,
+        offsets: np.ndarray,
+        num_rows: int,
+        queries: Optional[np.ndarray] = None,
+    ):
+        self.order = order
+        self.offsets = offsets
+        self.num_rows = num_rows
+        self.queries = queries
+
+    @property
+    def num_queries(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @classmethod
+    def create_instance_from_df(cls, df: pd.DataFrame, schema: Schema):
+        return cls.create_instance_from_values(df[schema.query_col])
+
+    @classmethod
+    def create_instance_from_values(cls, query_values: pd.Series):
+        # Sort the codes so queries are in the same order as a groupby
+        query_codes, queries = pd.factorize(query_values, sort=True)
+        if (query_codes < 0).any():
+            raise ValueError("Query values must not be null")
+        order = np.argsort(query_codes, kind="stable")
+        sizes = np.bincount(query_codes, minlength=len(queries))
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        return cls(
+            order=order,
+            offsets=offsets,
+            num_rows=len(query_codes),
+            queries=np.asarray(queries),
+        )
+
+    def _check_length(self, values: np.ndarray) -> None:
+        if len(values) != self.num_rows:
+            raise ValueError(
+                f"Expected {self.num_rows} values, got {len(values)}"
+            )
+
+    def gather(self, values) -> np.ndarray:
+        """
+        Reorder row values so each query is contiguous
+        """
+        values = np.asarray(values)
+        self._check_length(values)
+        return values[self.order]
+
+    def filter_queries(self, keep: np.ndarray):
+        """
+        Create a new QueryIndex only containing queries where keep is True
+        """
+        keep = np.asarray(keep, dtype=bool)
+        if len(keep) != self.num_queries:
+            raise ValueError(
+                f"Expected {self.num_queries} values, got {len(keep)}"
+            )
+        return QueryIndex(
+            order=self.order[np.repeat(keep, self.sizes)],
+            offsets=np.concatenate([[0], np.cumsum(self.sizes[keep])]),
+            num_rows=self.num_rows,
+            queries=None if self.queries is None else self.queries[keep],
+        )
+
+    def filter_small_queries(self, min_size: int = 2):
+        """
+        Remove queries with too few items to rank
+        """
+        return self.filter_queries(self.sizes >= min_size)
+
+    def filter_queries_without_positives(self, y_true):
+        """
+        Remove queries which had no relevant items
+        """
+        return self.filter_queries(self.aggregate(y_true > 0, "max") > 0)
+
+    def aggregate(self, values, aggregation: str) -> np.ndarray:
+        """
+        Reduce row values to one value per query
+        """
+        if aggregation not in self.VALID_AGGREGATIONS:
+            raise ValueError(
+                f"aggregation must be in {self.VALID_AGGREGATIONS}, "
+                f"got {aggregation}"
+            )
+        if aggregation == "size":
+            return self.sizes
+        grouped = self.gather(values)
+        if grouped.dtype == bool:
+            grouped = grouped.astype(np.int64)
+        if aggregation == "mean":
+            return self._reduce(grouped, np.add) / self.sizes
+        ufunc = {"sum": np.add, "min": np.minimum, "max": np.maximum}
+        return self._reduce(grouped, ufunc[aggregation])
+
+    def _reduce(self, grouped: np.ndarray, ufunc: np.ufunc) -> np.ndarray:
+        result = np.zeros(self.num_queries, dtype=grouped.dtype)
+        # reduceat can't handle empty queries
+        non_empty = self.sizes > 0
+        if non_empty.any():
+            result[non_empty] = ufunc.reduceat(
+                grouped, self.offsets[:-1][non_empty]
+            )
+        return result
+
+    def broadcast(self, query_values: np.ndarray) -> np.ndarray:
+        """
+        Give each row the value of its query, in the original row order
+        Rows in filtered out queries are NaN
+        """
+        query_values = np.asarray(query_values, dtype=np.float64)
+        result = np.full(self.num_rows, np.nan)
+        result[self.order] = np.repeat(query_values, self.sizes)
+        return result
+
+    def transform(self, values, aggregation: str) -> np.ndarray:
+        """
+        Per query aggregate given back to every row, like groupby.transform
+        Useful for query level features, eg. price relative to query mean
+        """
+        return self.broadcast(self.aggregate(values, aggregation))
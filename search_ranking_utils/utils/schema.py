@@ -13,6 +13,12 @@ class ImputeStrategy:
         self.impute_type = impute_type
         self.val = val
 
+    def to_dict(self) -> dict:
+        impute_config = {"impute_type": self.impute_type}
+        if self.val is not None:
+            impute_config["val"] = self.val
+        return impute_config
+
     def _check_type_valid(self, impute_type: str):
         if impute_type not in self.VALID_TYPES:
             raise ValueError(
@@ -35,6 +41,9 @@ class Feature:
             name=f_name, impute_strategy=ImputeStrategy(**f_config["impute"])
         )
 
+    def to_config(self) -> dict:
+        return {"impute": self.impute_strategy.to_dict()}
+
 
 class CategoricalFeature(Feature):
     VALID_IMPUTE_TYPES = ["mode", "val"]
@@ -45,12 +54,20 @@ class CategoricalFeature(Feature):
         name: str,
         impute_strategy: ImputeStrategy,
         max_categories: Optional[int] = None,
+        hash_buckets: Optional[int] = None,
     ):
         """
         Optionally limit the number of categories used for this feature
+        Or hash categories into a fixed number of buckets, needing no vocab
         """
         super().__init__(name, impute_strategy)
         self.max_categories = max_categories
+        self.hash_buckets = hash_buckets
+        if max_categories and hash_buckets:
+            raise ValueError(
+                f"Categorical feature {name} can't have both "
+                f"max_categories and hash_buckets"
+            )
         if self.impute_strategy.impute_type not in self.VALID_IMPUTE_TYPES:
             raise ValueError(
                 f"Categorical feature must have impute type "
@@ -64,8 +81,23 @@ class CategoricalFeature(Feature):
             name=f_name,
             impute_strategy=ImputeStrategy(**f_config["impute"]),
             max_categories=f_config.get("max_categories"),
+            hash_buckets=f_config.get("hash_buckets"),
         )
 
+    def to_config(self) -> dict:
+        f_config = super().to_config()
+        if self.max_categories:
+            f_config["max_categories"] = self.max_categories
+        if self.hash_buckets:
+            f_config["hash_buckets"] = self.hash_buckets
+        return f_config
+
+    def get_bucket_names(self) -> List[str]:
+        """
+        Model feature names of a hashed feature, <col_name>_hash_<bucket>
+        """
+        return [f"{self.name}_hash_{i}" for i in range(self.hash_buckets)]
+
 
 class Schema:
     def __init__(
@@ -92,9 +124,13 @@ class Schema:
             if f.impute_strategy.val is not None:
                 imputations[f.name] = f.impute_strategy.val
             else:
-                impute_val = df[f.name].aggregate(
-                    f.impute_strategy.impute_type
-                )
+                values = df[f.name]
+                # Break mode ties by value, not category order
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    values = values.cat.reorder_categories(
+                        sorted(values.cat.categories)
+                    )
+                impute_val = values.aggregate(f.impute_strategy.impute_type)
                 # Mode can be more than one value
                 if f.impute_strategy.impute_type == "mode":
                     impute_val = impute_val[0]
@@ -117,11 +153,16 @@ class Schema:
         """
         Creates a dictionary of categorical vocabs
         Limit the vocab size if provided
+        Hashed features don't need a vocab
         """
         vocabs = {}
         for f in self.categorical_features:
+            if f.hash_buckets:
+                continue
             # Don't want to include nan as a category
             categories = df[f.name].dropna().value_counts()
+            # Categorical dtypes also count unused categories
+            categories = categories[categories > 0]
             # Keep the most common categories only
             # Only do this if num categories exceeds max
             if f.max_categories and len(categories) > f.max_categories:
@@ -137,20 +178,50 @@ class Schema:
         self.set_norm_stats(df)
         self.set_vocabs(df)
 
+    def get_columns(self) -> List[str]:
+        """
+        All columns used from raw data, the features, target and query col
+        """
+        columns = [f.name for f in self.all_features]
+        columns.append(self.target)
+        columns.append(self.query_col)
+        return columns
+
     def get_model_features(self) -> List[str]:
         """
         In modelling, categorical cols get dropped
         Each categorical col is <col_name>_<cat_name>
+        Or <col_name>_hash_<bucket> for hashed features
         Requires vocab already set
         """
         if not hasattr(self, "vocabs"):
             raise NotImplementedError("Must set vocabs first")
         features = [f.name for f in self.numerical_features]
         for f in self.categorical_features:
+            if f.hash_buckets:
+                features.extend(f.get_bucket_names())
+                continue
             for category in self.vocabs[f.name]:
                 features.append(f"{f.name}_{category}")
         return features
 
+    def to_dict(self) -> dict:
+        """
+        Inverse of create_instance_from_dict, stats are not included
+        """
+        return {
+            "features": {
+                "categorical": {
+                    f.name: f.to_config() for f in self.categorical_features
+                },
+                "numerical": {
+                    f.name: f.to_config() for f in self.numerical_features
+                },
+            },
+            "target": self.target,
+            "query_col": self.query_col,
+        }
+
     @classmethod
     def create_instance_from_dict(cls, schema_dict: dict):
         logger.info(f"Creating schema using: {schema_dict}")
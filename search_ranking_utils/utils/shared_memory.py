@@ -0,0 +1,122 @@
+from typing import Dict, Tuple
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+import os
+import numpy as np
+
+
+def get_num_jobs(n_jobs: int) -> int:
+    """
+    Number of worker processes to use, -1 means one per CPU
+    """
+    if n_jobs == -1:
+        return os.cpu_count() or 1
+    if n_jobs < 1:
+        raise ValueError(f"n_jobs must be a positive int or -1, got {n_jobs}")
+    return n_jobs
+
+
+@dataclass
+class SharedArraySpec:
+    """
+    Everything a worker process needs to attach to a shared array
+    Small enough to pickle cheaply instead of the array itself
+    """
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    def attach(self) -> Tuple[SharedMemory, np.ndarray]:
+        """
+        Return the block as well as the array
+        The block must stay referenced, and be closed, by the caller
+        """
+        shm = SharedMemory(name=self.name)
+        arr = np.ndarray(
+            self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf
+        )
+        return shm, arr
+
+
+@dataclass
+class MemmapArraySpec:
+    """
+    Same as SharedArraySpec for an array memory mapped from a file
+    eg. an output too large to also hold in RAM
+    """
+
+    filename: str
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: str
+
+    @classmethod
+    def create_instance_from_memmap(cls, arr: np.memmap):
+        if not isinstance(arr, np.memmap) or arr.filename is None:
+            raise ValueError("Array must be memory mapped from a file")
+        return cls(
+            filename=arr.filename,
+            offset=arr.offset,
+            shape=arr.shape,
+            dtype=arr.dtype.str,
+        )
+
+    def attach(self) -> Tuple[None, np.memmap]:
+        """
+        No block to close, writes go to the file when the map is flushed
+        """
+        arr = np.memmap(
+            self.filename,
+            dtype=np.dtype(self.dtype),
+            mode="r+",
+            offset=self.offset,
+            shape=self.shape,
+        )
+        return None, arr
+
+
+class SharedArrays:
+    """
+    Copy numpy arrays into shared memory blocks for worker processes
+    Use as a context manager so the blocks are always freed
+    Arrays can also be allocated empty for workers to write into
+    """
+
+    def __init__(self):
+        self.blocks: Dict[str, SharedMemory] = {}
+        self.specs: Dict[str, SharedArraySpec] = {}
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def allocate(
+        self, key: str, shape: Tuple[int, ...], dtype: np.dtype
+    ) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        # Zero sized blocks aren't allowed
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = SharedMemory(create=True, size=size)
+        self.blocks[key] = shm
+        self.specs[key] = SharedArraySpec(
+            name=shm.name, shape=tuple(shape), dtype=dtype.str
+        )
+        self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return self.arrays[key]
+
+    def add(self, key: str, arr: np.ndarray) -> SharedArraySpec:
+        arr = np.ascontiguousarray(arr)
+        self.allocate(key, arr.shape, arr.dtype)[...] = arr
+        return self.specs[key]
+
+    def close(self) -> None:
+        # Views must be released before the buffer can be closed
+        self.arrays = {}
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
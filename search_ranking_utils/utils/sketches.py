@@ -0,0 +1,212 @@
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+
+
+class RunningMoments:
+    """
+    Exact count, mean, std, min and max over a stream of values
+    Each chunk is summarised with numpy, then combined with the running
+    stats using Welford/Chan's update, so it is numerically stable
+    Nulls are ignored, like pandas
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        chunk_mean = values.mean()
+        self._combine(
+            count=len(values),
+            mean=chunk_mean,
+            m2=((values - chunk_mean) ** 2).sum(),
+            min_val=values.min(),
+            max_val=values.max(),
+        )
+
+    def merge(self, other: "RunningMoments") -> "RunningMoments":
+        """
+        Exact, the same as if all values were seen by one object
+        """
+        if other.count > 0:
+            self._combine(
+                other.count, other.mean, other.m2, other.min, other.max
+            )
+        return self
+
+    def _combine(
+        self,
+        count: int,
+        mean: float,
+        m2: float,
+        min_val: float,
+        max_val: float,
+    ) -> None:
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, min_val)
+        self.max = max(self.max, max_val)
+
+    @property
+    def std(self) -> float:
+        """
+        Sample std (ddof=1), the same as pandas
+        """
+        if self.count < 2:
+            return np.nan
+        return float(np.sqrt(self.m2 / (self.count - 1)))
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch, memory is O(k) however many values are added
+    Values are kept in levels, a value at level h stands for 2^h values
+    When a level is full it is sorted and every other value is promoted
+    Rank error is about 1.7 / k with high probability,
+    eg. k=200 gives quantiles within about 1% of rank
+    Until the first compaction, all values are kept and quantiles are exact
+    """
+
+    def __init__(self, k: int = 200, seed: Optional[int] = None):
+        self.k = k
+        self.count = 0
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        Approximate, the merged sketch keeps the same error bound
+        """
+        if other.k != self.k:
+            raise ValueError("Can only merge sketches with equal k")
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # Odd one out stays at this level
+                odd = len(items) % 2
+                pairs = items[odd:]
+                offset = self.rng.integers(2)
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], pairs[offset::2]]
+                )
+                # Capacities shrink as the sketch grows, so start again
+                level = 0
+            else:
+                level += 1
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.quantile(self.levels[0], q))
+        items = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(lvl), 2**h) for h, lvl in enumerate(self.levels)]
+        )
+        order = np.argsort(items)
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1])
+        return float(items[order][min(position, len(items) - 1)])
+
+
+class FrequentItemsSketch:
+    """
+    Misra-Gries frequent items, keeping at most capacity counters
+    Counts are underestimated by at most N / (capacity + 1)
+    So any item seen more than that many times is always kept
+    With no capacity every item is counted exactly
+    Nulls are ignored, like pandas value_counts
+    """
+
+    def __init__(self, capacity: Optional[int] = None):
+        self.capacity = capacity
+        self.count = 0
+        self.counts = pd.Series(dtype=np.int64)
+        # True once any counts have been reduced
+        self.approximate = False
+
+    def update(self, values: pd.Series) -> None:
+        chunk_counts = pd.Series(values).dropna().value_counts()
+        # Categorical dtypes also count unused categories
+        chunk_counts = chunk_counts[chunk_counts > 0]
+        if isinstance(chunk_counts.index, pd.CategoricalIndex):
+            chunk_counts.index = chunk_counts.index.astype(object)
+        self.count += int(chunk_counts.sum())
+        self._add_counts(chunk_counts)
+
+    def merge(self, other: "FrequentItemsSketch") -> "FrequentItemsSketch":
+        """
+        Exact without a capacity, otherwise the error bound still holds
+        for the combined count
+        """
+        if other.capacity != self.capacity:
+            raise ValueError("Can only merge sketches with equal capacity")
+        self.count += other.count
+        self.approximate = self.approximate or other.approximate
+        self._add_counts(other.counts)
+        return self
+
+    def _add_counts(self, counts: pd.Series) -> None:
+        self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+        if self.capacity is not None and len(self.counts) > self.capacity:
+            # Subtract the (capacity + 1)th largest count from every counter
+            threshold = self.counts.nlargest(self.capacity + 1).iloc[-1]
+            self.counts = self.counts[self.counts > threshold] - threshold
+            self.approximate = True
+
+    @property
+    def error_bound(self) -> float:
+        if self.capacity is None:
+            return 0.0
+        return self.count / (self.capacity + 1)
+
+    def most_common(self, n: Optional[int] = None) -> pd.Series:
+        """
+        Highest counts first, ties broken by value
+        """
+        counts = self.counts.sort_index(kind="stable").sort_values(
+            ascending=False, kind="stable"
+        )
+        return counts if n is None else counts.head(n)
+
+    def mode(self):
+        """
+        Most common item, smallest value on ties like pandas mode
+        """
+        return self.most_common(1).index[0]
@@ -0,0 +1,225 @@
+from typing import Iterable, List, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor
+import logging
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import (
+    Schema,
+    Feature,
+    CategoricalFeature,
+)
+from search_ranking_utils.utils.sketches import (
+    RunningMoments,
+    QuantileSketch,
+    FrequentItemsSketch,
+)
+from search_ranking_utils.utils.shared_memory import get_num_jobs
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaStatsBuilder:
+    """
+    Build the schema's imputations, norm stats and vocabs in one pass
+    over chunks of data, so the data never needs to fit in memory
+
+    - mean, std, min and max are exact
+    - median uses a QuantileSketch, rank error about 1.7 / quantile_k
+    - capped vocabs use a FrequentItemsSketch keeping
+      frequent_items_factor * max_categories counters, numerical modes
+      keep mode_capacity counters, counts are underestimated by at most
+      N / (counters + 1)
+    - uncapped vocabs are counted exactly, they need every category
+    - hashed features need no vocab, only a mode sketch if imputing mode
+    While the sketches have not had to compact, results match set_stats
+    """
+
+    def __init__(
+        self,
+        schema: Schema,
+        quantile_k: int = 200,
+        frequent_items_factor: int = 10,
+        mode_capacity: int = 1000,
+        seed: Optional[int] = None,
+    ):
+        self.schema = schema
+        self.num_rows = 0
+        self.moments = {}
+        self.quantiles = {}
+        self.frequent_items = {}
+        for f in schema.numerical_features:
+            self.moments[f.name] = RunningMoments()
+            if f.impute_strategy.impute_type == "median":
+                self.quantiles[f.name] = QuantileSketch(quantile_k, seed)
+            if f.impute_strategy.impute_type == "mode":
+                self.frequent_items[f.name] = FrequentItemsSketch(
+                    mode_capacity
+                )
+        for f in schema.categorical_features:
+            if f.hash_buckets:
+                # Hashed features only need counts to impute the mode
+                if f.impute_strategy.impute_type == "mode":
+                    self.frequent_items[f.name] = FrequentItemsSketch(
+                        mode_capacity
+                    )
+                continue
+            capacity = None
+            if f.max_categories:
+                capacity = frequent_items_factor * f.max_categories
+            self.frequent_items[f.name] = FrequentItemsSketch(capacity)
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        for name, moments in self.moments.items():
+            moments.update(chunk[name].to_numpy(dtype=float, na_value=np.nan))
+        for name, sketch in self.quantiles.items():
+            sketch.update(chunk[name].to_numpy(dtype=float, na_value=np.nan))
+        for name, sketch in self.frequent_items.items():
+            sketch.update(chunk[name])
+        self.num_rows += len(chunk)
+
+    def merge(self, other: "SchemaStatsBuilder") -> "SchemaStatsBuilder":
+        """
+        Combine partial stats, eg. built from different files in parallel
+        Counts, sums and category counts merge exactly, quantiles approximately
+        """
+        for name, moments in self.moments.items():
+            moments.merge(other.moments[name])
+        for name, sketch in self.quantiles.items():
+            sketch.merge(other.quantiles[name])
+        for name, sketch in self.frequent_items.items():
+            sketch.merge(other.frequent_items[name])
+        self.num_rows += other.num_rows
+        return self
+
+    def _get_impute_val(self, f: Feature) -> object:
+        impute_type = f.impute_strategy.impute_type
+        if f.impute_strategy.val is not None:
+            return f.impute_strategy.val
+        if impute_type == "mode":
+            return self.frequent_items[f.name].mode()
+        if impute_type == "median":
+            return self.quantiles[f.name].quantile(0.5)
+        # mean, min and max are running moments
+        return getattr(self.moments[f.name], impute_type)
+
+    def _get_vocab(self, f: CategoricalFeature) -> list:
+        sketch = self.frequent_items[f.name]
+        categories = sketch.most_common()
+        # Compacting means there were more categories than counters
+        if f.max_categories and (
+            sketch.approximate or len(categories) > f.max_categories
+        ):
+            categories = list(categories.head(f.max_categories).index)
+            categories.append(CategoricalFeature.DEFAULT_VAL)
+        else:
+            categories = list(categories.index)
+        return sorted(categories)
+
+    def set_schema_stats(self) -> None:
+        """
+        Populate the schema's imputations, norm_stats and vocabs
+        """
+        logger.info(f"Setting schema stats from {self.num_rows} rows")
+        self.schema.imputations = {
+            f.name: self._get_impute_val(f) for f in self.schema.all_features
+        }
+        self.schema.norm_stats = {
+            f.name: {
+                "mean": self.moments[f.name].mean,
+                "std": self.moments[f.name].std,
+            }
+            for f in self.schema.numerical_features
+        }
+        self.schema.vocabs = {
+            f.name: self._get_vocab(f)
+            for f in self.schema.categorical_features
+            if not f.hash_buckets
+        }
+
+
+def set_stats_from_chunks(
+    schema: Schema, chunks: Iterable[pd.DataFrame], **kwargs
+) -> SchemaStatsBuilder:
+    """
+    Streaming equivalent of schema.set_stats(df)
+    kwargs are passed to the SchemaStatsBuilder
+    """
+    builder = SchemaStatsBuilder(schema, **kwargs)
+    for chunk in chunks:
+        builder.update(chunk)
+    builder.set_schema_stats()
+    return builder
+
+
+def read_chunks(
+    path: str,
+    chunksize: Optional[int] = None,
+    columns: Optional[List[str]] = None,
+) -> Iterable[pd.DataFrame]:
+    """
+    Read a CSV or Parquet file, optionally in chunks for CSVs
+    Only columns are parsed if given
+    """
+    if path.endswith(".parquet"):
+        return [pd.read_parquet(path, columns=columns)]
+    if chunksize:
+        return pd.read_csv(path, chunksize=chunksize, usecols=columns)
+    return [pd.read_csv(path, usecols=columns)]
+
+
+def build_partial_stats(
+    schema: Schema, path: str, chunksize: Optional[int] = None, **kwargs
+) -> SchemaStatsBuilder:
+    """
+    Stats for a single shard, small enough to send back from a worker
+    """
+    builder = SchemaStatsBuilder(schema, **kwargs)
+    columns = [f.name for f in schema.all_features]
+    for chunk in read_chunks(path, chunksize, columns):
+        builder.update(chunk)
+    return builder
+
+
+def set_stats_from_files(
+    schema: Schema,
+    paths: List[str],
+    n_jobs: int = 1,
+    chunksize: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    **kwargs,
+) -> SchemaStatsBuilder:
+    """
+    Fit the schema stats on many shards, eg. day partitioned files
+    Each shard is summarised in a process pool, or the executor if given
+    The partial stats are then merged, so no data is ever concatenated
+    kwargs are passed to each SchemaStatsBuilder
+    n_jobs=-1 uses one process per CPU
+    """
+    n_jobs = get_num_jobs(n_jobs)
+    if n_jobs == 1 and executor is None:
+        partials = [
+            build_partial_stats(schema, path, chunksize, **kwargs)
+            for path in paths
+        ]
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+        try:
+            futures = [
+                executor.submit(
+                    build_partial_stats, schema, path, chunksize, **kwargs
+                )
+                for path in paths
+            ]
+            partials = [future.result() for future in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+    logger.info(f"Merging stats from {len(partials)} shards")
+    # Stats are set on the schema passed in, not the workers' copies
+    builder = SchemaStatsBuilder(schema, **kwargs)
+    for partial in partials:
+        builder.merge(partial)
+    builder.set_schema_stats()
+    return builder
@@ -1,9 +1,11 @@
 import os
 import pytest
+import numpy as np
 import pandas as pd
 from search_ranking_utils.utils.files import load_json
 from search_ranking_utils.utils.schema import Schema
 from search_ranking_utils.preprocessing.preprocessor import Preprocessor
+from search_ranking_utils.preprocessing.text_embedding import hash_texts
 
 """
 Contains reusable artifacts for tests like data and config
@@ -14,6 +16,11 @@ DUMMY_CSV_PATH = os.path.join(LOCAL_DIRECTORY, "data", "dummy_data.csv")
 DUMMY_SCHEMA_PATH = os.path.join(LOCAL_DIRECTORY, "config", "schema.json")
 
 
+@pytest.fixture(scope="session")
+def dummy_csv_path() -> str:
+    return DUMMY_CSV_PATH
+
+
 @pytest.fixture(scope="session")
 def dummy_df() -> pd.DataFrame:
     df = pd.read_csv(DUMMY_CSV_PATH)
@@ -21,9 +28,13 @@ def dummy_df() -> pd.DataFrame:
 
 
 @pytest.fixture(scope="session")
-def dummy_schema(dummy_df) -> Schema:
-    schema_dict = load_json(DUMMY_SCHEMA_PATH)
-    schema = Schema.create_instance_from_dict(schema_dict)
+def dummy_schema_dict() -> dict:
+    return load_json(DUMMY_SCHEMA_PATH)
+
+
+@pytest.fixture(scope="session")
+def dummy_schema(dummy_df, dummy_schema_dict) -> Schema:
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
     schema.set_stats(dummy_df)
     return schema
 
@@ -32,3 +43,29 @@ def dummy_schema(dummy_df) -> Schema:
 def dummy_trainable_df(dummy_df, dummy_schema) -> pd.DataFrame:
     preprocessor = Preprocessor(dummy_df, dummy_schema)
     return preprocessor(dummy_df)
+
+
+@pytest.fixture(scope="session")
+def counting_encoder_cls() -> type:
+    return CountingEncoder
+
+
+class CountingEncoder:
+    """
+    Deterministic stand in for a SentenceTransformer
+    Records every text it encodes, to check what was (re)computed
+    """
+
+    def __init__(self, dim: int = 4):
+        self.dim = dim
+        self.encoded = []
+
+    def encode(self, texts) -> np.ndarray:
+        self.encoded.extend(texts)
+        seeds = hash_texts(texts) % np.uint64(2**32)
+        return np.stack(
+            [
+                np.random.default_rng(seed).normal(size=self.dim)
+                for seed in seeds
+            ]
+        ).astype(np.float32)
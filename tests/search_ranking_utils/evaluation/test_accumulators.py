@@ -0,0 +1,132 @@
+import pytest
+import numpy as np
+import pandas as pd
+from sklearn.metrics import log_loss, accuracy_score, roc_auc_score
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.evaluation.metrics import get_ranking_metrics
+from search_ranking_utils.evaluation.accumulators import (
+    MetricAccumulator,
+    LogLossAccumulator,
+    AccuracyAccumulator,
+    HistogramAUCAccumulator,
+    RankingMetricAccumulator,
+    accumulate_metrics,
+)
+
+
+@pytest.fixture
+def scored_df() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    # Sorted by query so no query spans chunks
+    query_id = np.sort(rng.integers(0, 100, 1000))
+    interacted = rng.integers(0, 2, 1000)
+    prediction = np.clip(0.3 * interacted + 0.7 * rng.random(1000), 0, 1)
+    return pd.DataFrame(
+        {
+            "query_id": query_id,
+            "interacted": interacted,
+            "prediction": prediction,
+        }
+    )
+
+
+@pytest.fixture
+def schema() -> Schema:
+    return Schema(target="interacted", query_col="query_id")
+
+
+def _get_chunks(df: pd.DataFrame):
+    # Split on query boundaries
+    boundaries = np.flatnonzero(np.diff(df["query_id"].to_numpy())) + 1
+    for rows in np.array_split(np.arange(len(df)), boundaries[::10]):
+        yield df.iloc[rows]
+
+
+def test_log_loss_and_accuracy_accumulators(scored_df, schema):
+    metrics = accumulate_metrics(
+        _get_chunks(scored_df),
+        [
+            LogLossAccumulator(schema, "prediction"),
+            AccuracyAccumulator(schema, "prediction"),
+        ],
+    )
+    assert metrics["log_loss"] == pytest.approx(
+        log_loss(scored_df["interacted"], scored_df["prediction"])
+    )
+    assert metrics["accuracy_score"] == pytest.approx(
+        accuracy_score(scored_df["interacted"], scored_df["prediction"] > 0.5)
+    )
+
+
+def test_histogram_auc_accumulator(scored_df, schema):
+    accumulator = HistogramAUCAccumulator(schema, "prediction", num_bins=100)
+    accumulate_metrics(_get_chunks(scored_df), [accumulator])
+    expected = roc_auc_score(scored_df["interacted"], scored_df["prediction"])
+    result = accumulator.result()["roc_auc_score"]
+    assert abs(result - expected) <= accumulator.error_bound()
+    # Finer bins reduce the error bound
+    fine_accumulator = HistogramAUCAccumulator(
+        schema, "prediction", num_bins=100000
+    )
+    fine_accumulator.update(scored_df)
+    assert fine_accumulator.error_bound() < accumulator.error_bound()
+
+
+def test_histogram_auc_accumulator_score_range(scored_df, schema):
+    logits_df = scored_df.assign(
+        prediction=np.log(scored_df["prediction"] + 0.01)
+    )
+    with pytest.raises(ValueError):
+        HistogramAUCAccumulator(schema, "prediction").update(logits_df)
+    accumulator = HistogramAUCAccumulator(
+        schema, "prediction", num_bins=1000, score_min=-5, score_max=1
+    )
+    accumulator.update(logits_df)
+    expected = roc_auc_score(logits_df["interacted"], logits_df["prediction"])
+    result = accumulator.result()["roc_auc_score"]
+    assert abs(result - expected) <= accumulator.error_bound()
+
+
+@pytest.mark.parametrize(
+    argnames="accumulator_cls",
+    argvalues=[
+        LogLossAccumulator,
+        AccuracyAccumulator,
+        HistogramAUCAccumulator,
+    ],
+)
+def test_accumulator_result_before_update(schema, accumulator_cls):
+    result = accumulator_cls(schema, "prediction").result()
+    assert all(np.isnan(value) for value in result.values())
+
+
+def test_ranking_metric_accumulator_result_before_update(schema):
+    accumulator = RankingMetricAccumulator(
+        schema, "prediction", ["ndcg_score"]
+    )
+    assert np.isnan(accumulator.result()["ndcg_score"])
+
+
+def test_metric_accumulator_is_abstract(schema):
+    with pytest.raises(TypeError):
+        MetricAccumulator(schema, "prediction")
+
+
+def test_ranking_metric_accumulator_merge(scored_df, schema):
+    ranking_metrics = ["ndcg_score", "average_precision@5"]
+    expected = get_ranking_metrics(
+        scored_df, schema, "prediction", ranking_metrics
+    )
+    accumulators = []
+    for chunk in _get_chunks(scored_df):
+        accumulator = RankingMetricAccumulator(
+            schema, "prediction", ranking_metrics
+        )
+        accumulator.update(chunk)
+        accumulators.append(accumulator)
+    merged = accumulators[0]
+    for accumulator in accumulators[1:]:
+        merged.merge(accumulator)
+    result = merged.result()
+    for metric in ranking_metrics:
+        assert result[metric] == pytest.approx(expected[metric])
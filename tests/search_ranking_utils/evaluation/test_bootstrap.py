@@ -0,0 +1,66 @@
+import pytest
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.evaluation.metrics import get_ranking_metrics
+from search_ranking_utils.evaluation.bootstrap import (
+    get_bootstrap_means,
+    bootstrap_ranking_metrics,
+)
+
+
+@pytest.fixture
+def scored_df() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    interacted = rng.integers(0, 2, 2000)
+    return pd.DataFrame(
+        {
+            "query_id": rng.integers(0, 200, 2000),
+            "interacted": interacted,
+            "good_model": 0.5 * interacted + rng.random(2000),
+            "random_model": rng.random(2000),
+        }
+    )
+
+
+def test_get_bootstrap_means():
+    query_metrics = np.array([[0.0, 1.0], [1.0, 1.0], [0.5, 1.0]])
+    means = get_bootstrap_means(
+        query_metrics, num_resamples=250, batch_size=100, seed=0
+    )
+    assert means.shape == (250, 2)
+    # Constant column never changes
+    np.testing.assert_allclose(means[:, 1], 1.0)
+    assert means[:, 0].min() >= 0.0 and means[:, 0].max() <= 1.0
+    # Same seed gives the same resamples
+    np.testing.assert_array_equal(
+        means, get_bootstrap_means(query_metrics, 250, 100, seed=0)
+    )
+
+
+def test_bootstrap_ranking_metrics(scored_df):
+    schema = Schema(target="interacted", query_col="query_id")
+    results = bootstrap_ranking_metrics(
+        scored_df,
+        schema,
+        ["good_model"],
+        ["ndcg_score", "reciprocal_rank"],
+        baseline_col="random_model",
+        num_resamples=200,
+        seed=0,
+    )
+    assert len(results) == 4
+    good = results.loc[("ndcg_score", "good_model")]
+    expected = get_ranking_metrics(
+        scored_df, schema, "good_model", ["ndcg_score"]
+    )["ndcg_score"]
+    assert good["value"] == pytest.approx(expected)
+    assert good["lower"] <= good["value"] <= good["upper"]
+    # Good model should be significantly better than random
+    assert good["diff"] > 0
+    assert good["diff_lower"] > 0
+    assert good["p_value"] < 0.05
+    # Baseline compared to itself
+    baseline = results.loc[("ndcg_score", "random_model")]
+    assert baseline["diff"] == 0.0
+    assert baseline["p_value"] == 1.0
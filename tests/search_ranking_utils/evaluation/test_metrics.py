@@ -1,12 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 import pytest
+import numpy as np
 import pandas as pd
 from search_ranking_utils.utils.testing import assert_dicts_equal
+from search_ranking_utils.utils.query_index import QueryIndex
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.utils.shared_memory import SharedArrays
 from search_ranking_utils.preprocessing.data_preprocessing import split_dataset
 from search_ranking_utils.modelling.model_factory import ModelFactory
 from search_ranking_utils.evaluation.metrics import (
     get_pointwise_metrics,
     calculate_query_ranking_metric,
     get_ranking_metrics,
+    RankedQueries,
+    calculate_segmented_ranking_metric,
+    _get_shard_bounds,
+    _evaluate_ranking_shard,
+    SortedPredictions,
+    SKLEARN_METRICS_MODULE,
 )
 
 
@@ -42,3 +53,197 @@ def test_get_ranking_metrics(predicted_df, dummy_schema):
     )
     expected_metrics = {"ndcg_score": 0.8154648767857287}
     assert_dicts_equal(expected_metrics, metrics)
+
+
+@pytest.fixture
+def ranked_queries() -> RankedQueries:
+    # Second query has a tie between its first two predictions
+    return RankedQueries.create_instance_from_arrays(
+        y_true=np.array([0.0, 1.0, 0.0, 1.0, 0.0, 0.0, 1.0]),
+        y_pred=np.array([0.8, 0.6, 0.7, 0.5, 0.5, 0.9, 0.1]),
+        offsets=np.array([0, 3, 7]),
+    )
+
+
+@pytest.mark.parametrize(
+    argnames="ranking_metric_name",
+    argvalues=["ndcg_score", "ndcg_score@2", "dcg_score", "dcg_score@3"],
+)
+def test_calculate_segmented_ranking_metric_matches_sklearn(
+    ranked_queries, ranking_metric_name
+):
+    y_true = pd.Series([[0.0, 1.0, 0.0], [1.0, 0.0, 0.0, 1.0]])
+    y_pred = pd.Series([[0.8, 0.6, 0.7], [0.5, 0.5, 0.9, 0.1]])
+    expected = calculate_query_ranking_metric(
+        y_true, y_pred, ranking_metric_name
+    )
+    result = calculate_segmented_ranking_metric(
+        ranked_queries, ranking_metric_name
+    )
+    assert result.shape == (2,)
+    assert result.mean() == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    argnames=["ranking_metric_name", "expected"],
+    argvalues=[
+        ("reciprocal_rank", [1 / 3, 1 / 2]),
+        ("reciprocal_rank@1", [0.0, 0.0]),
+        ("precision@2", [0.0, 0.5]),
+        ("precision", [1 / 3, 1 / 2]),
+        ("average_precision", [1 / 3, (1 / 2 + 2 / 4) / 2]),
+        ("average_precision@2", [0.0, 1 / 4]),
+    ],
+)
+def test_calculate_segmented_ranking_metric(
+    ranked_queries, ranking_metric_name, expected
+):
+    result = calculate_segmented_ranking_metric(
+        ranked_queries, ranking_metric_name
+    )
+    np.testing.assert_allclose(expected, result)
+
+
+def test_calculate_segmented_ranking_metric_invalid(ranked_queries):
+    with pytest.raises(ValueError):
+        calculate_segmented_ranking_metric(ranked_queries, "roc_auc_score")
+
+
+def test_get_ranking_metrics_reuse_query_index(predicted_df, dummy_schema):
+    query_index = QueryIndex.create_instance_from_df(
+        predicted_df, dummy_schema
+    )
+    df = predicted_df.assign(reversed=-predicted_df["prediction"])
+    for y_pred_col in ["prediction", "reversed"]:
+        expected = get_ranking_metrics(
+            df, dummy_schema, y_pred_col, ["ndcg_score", "precision@1"]
+        )
+        result = get_ranking_metrics(
+            df,
+            dummy_schema,
+            y_pred_col,
+            ["ndcg_score", "precision@1"],
+            query_index=query_index,
+        )
+        assert_dicts_equal(expected, result)
+
+
+def test_get_shard_bounds():
+    offsets = np.array([0, 2, 3, 7, 8, 10])
+    bounds = _get_shard_bounds(offsets, 2)
+    np.testing.assert_array_equal(bounds, [0, 3, 5])
+    # Never more shards than queries
+    bounds = _get_shard_bounds(offsets, 10)
+    np.testing.assert_array_equal(bounds, [0, 1, 2, 3, 4, 5])
+
+
+def test_get_ranking_metrics_sharded():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "query_id": rng.integers(0, 50, 500),
+            "interacted": rng.integers(0, 2, 500),
+            "prediction": rng.random(500),
+        }
+    )
+    schema = Schema(target="interacted", query_col="query_id")
+    ranking_metrics = ["ndcg_score", "reciprocal_rank", "precision@3"]
+    expected = get_ranking_metrics(df, schema, "prediction", ranking_metrics)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = get_ranking_metrics(
+            df,
+            schema,
+            "prediction",
+            ranking_metrics,
+            n_jobs=3,
+            executor=executor,
+        )
+    for metric in ranking_metrics:
+        assert result[metric] == pytest.approx(expected[metric])
+    # Default process pool
+    result = get_ranking_metrics(
+        df, schema, "prediction", ranking_metrics, n_jobs=2
+    )
+    for metric in ranking_metrics:
+        assert result[metric] == pytest.approx(expected[metric])
+
+
+def test_evaluate_ranking_shard_raises_worker_error():
+    with SharedArrays() as shared:
+        shared.add("y_true", np.array([1.0, 0.0]))
+        shared.add("y_pred", np.array([0.2, 0.1]))
+        # The real error isn't hidden by cleaning up
+        with pytest.raises(KeyError):
+            _evaluate_ranking_shard(shared.specs, 0, 1, ["ndcg_score"])
+
+
+def test_get_ranking_metrics_sharded_no_rankable_queries():
+    # Every query has a single row, so none can be ranked
+    df = pd.DataFrame(
+        {
+            "query_id": [1, 2, 3],
+            "interacted": [1, 0, 1],
+            "prediction": [0.1, 0.2, 0.3],
+        }
+    )
+    schema = Schema(target="interacted", query_col="query_id")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = get_ranking_metrics(
+            df,
+            schema,
+            "prediction",
+            ["ndcg_score"],
+            n_jobs=2,
+            executor=executor,
+        )
+    assert np.isnan(result["ndcg_score"])
+
+
+@pytest.mark.parametrize(argnames="n_jobs", argvalues=[0, -2])
+def test_get_ranking_metrics_invalid_n_jobs(n_jobs):
+    df = pd.DataFrame(
+        {"query_id": [1, 1], "interacted": [1, 0], "prediction": [0.1, 0.2]}
+    )
+    schema = Schema(target="interacted", query_col="query_id")
+    with pytest.raises(ValueError):
+        get_ranking_metrics(
+            df, schema, "prediction", ["ndcg_score"], n_jobs=n_jobs
+        )
+
+
+@pytest.mark.parametrize(
+    argnames="metric",
+    argvalues=[
+        "roc_auc_score",
+        "average_precision_score",
+        "log_loss",
+        "brier_score_loss",
+    ],
+)
+def test_get_pointwise_metrics_fused_matches_sklearn(metric):
+    rng = np.random.default_rng(0)
+    interacted = rng.integers(0, 2, 500)
+    # Rounding creates tied scores
+    prediction = np.round(0.3 * interacted + 0.7 * rng.random(500), 2)
+    df = pd.DataFrame({"interacted": interacted, "prediction": prediction})
+    schema = Schema(target="interacted", query_col="query_id")
+    metrics = get_pointwise_metrics(df, schema, "prediction", [metric])
+    expected = getattr(SKLEARN_METRICS_MODULE, metric)(
+        df["interacted"], df["prediction"]
+    )
+    assert metrics[metric] == pytest.approx(expected)
+
+
+def test_sorted_predictions_calibration_bins():
+    sorted_predictions = SortedPredictions.create_instance_from_arrays(
+        y_true=np.array([0, 1, 1, 0, 1]),
+        y_pred=np.array([0.1, 0.15, 0.9, 0.95, 1.0]),
+    )
+    bins = sorted_predictions.calibration_bins(num_bins=2)
+    np.testing.assert_array_equal(bins["bin_lower"], [0.0, 0.5])
+    np.testing.assert_array_equal(bins["count"], [2, 3])
+    np.testing.assert_allclose(bins["mean_prediction"], [0.125, 0.95])
+    np.testing.assert_allclose(bins["mean_target"], [0.5, 2 / 3])
+    assert sorted_predictions.expected_calibration_error(
+        num_bins=2
+    ) == pytest.approx((2 * 0.375 + 3 * (0.95 - 2 / 3)) / 5)
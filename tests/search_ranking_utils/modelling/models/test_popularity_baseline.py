@@ -1,4 +1,5 @@
 import pytest
+import numpy as np
 import pandas as pd
 from search_ranking_utils.modelling.models.popularity_baseline import (
     PopularityBaseline,
@@ -33,16 +34,72 @@ def test_populatiy_baseline_predict_proba(
     scores = model.predict_proba(dummy_df)
 
     # Check the scores
+    assert scores.shape == (len(dummy_df), 2)
     assert scores[0][0] == 0.0
-    assert scores[0][1] == 1.0
-    assert scores[0][4] == 0.0
     assert scores[1][0] == 1.0
+    assert scores[4][0] == 0.0
+    assert scores[0][1] == 1.0
     assert scores[1][1] == 0.0
-    assert scores[1][4] == 1.0
+    assert scores[4][1] == 1.0
 
     # Check the OOV products
     # Add on a row of data and change the product_id
     df = pd.concat([dummy_df, dummy_df.iloc[0]])
     df.iloc[-1]["product_id"] = "prod200"
-    assert model.predict_proba(df)[0][-1] == 1 - expected_default_val
-    assert model.predict_proba(df)[1][-1] == expected_default_val
+    assert model.predict_proba(df)[-1][0] == 1 - expected_default_val
+    assert model.predict_proba(df)[-1][1] == expected_default_val
+
+
+def test_popularity_baseline_partial_fit(dummy_df, dummy_schema):
+    model = PopularityBaseline(dummy_schema.target, "product_id")
+    model.fit(dummy_df)
+    chunked_model = PopularityBaseline(dummy_schema.target, "product_id")
+    for chunk in [dummy_df.iloc[:3], dummy_df.iloc[3:]]:
+        chunked_model.partial_fit(chunk)
+    np.testing.assert_array_equal(
+        model.predict_proba(dummy_df), chunked_model.predict_proba(dummy_df)
+    )
+    assert chunked_model.global_val == 2 / 7
+
+
+@pytest.mark.parametrize(argnames="prior_strength", argvalues=[0.0, 1.0])
+def test_popularity_baseline_partial_fit_no_target(
+    dummy_df, dummy_schema, prior_strength
+):
+    model = PopularityBaseline(
+        dummy_schema.target, "product_id", prior_strength=prior_strength
+    )
+    model.partial_fit(dummy_df.iloc[:0])
+    assert np.isnan(model.global_val)
+    null_target = dummy_df.iloc[:3].assign(**{dummy_schema.target: np.nan})
+    model.partial_fit(null_target)
+    assert np.isnan(model.global_val)
+    # Later chunks give the same result as never seeing the empty ones
+    model.partial_fit(dummy_df)
+    expected = PopularityBaseline(
+        dummy_schema.target, "product_id", prior_strength=prior_strength
+    ).fit(dummy_df)
+    assert model.global_val == expected.global_val
+    np.testing.assert_allclose(
+        model.predict_proba(dummy_df), expected.predict_proba(dummy_df)
+    )
+
+
+def test_popularity_baseline_prior_strength(dummy_df, dummy_schema):
+    model = PopularityBaseline(
+        dummy_schema.target, "product_id", prior_strength=1.0
+    )
+    model.fit(dummy_df)
+    scores = model.predict_proba(dummy_df)[:, 1]
+    # One row with target 1, smoothed with one row at the global rate
+    assert scores[0] == pytest.approx((1 + 2 / 7) / 2)
+    np.testing.assert_allclose(scores + model.predict_proba(dummy_df)[:, 0], 1)
+
+
+def test_popularity_baseline_missing_item_ids(dummy_df, dummy_schema):
+    df = dummy_df.copy()
+    df.loc[df[dummy_schema.target] == 0, "product_id"] = np.nan
+    model = PopularityBaseline(dummy_schema.target, "product_id")
+    model.fit(df)
+    # Rows without an item id still count towards the global probability
+    assert model.global_val == df[dummy_schema.target].mean()
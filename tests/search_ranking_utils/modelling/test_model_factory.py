@@ -3,6 +3,7 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
 from search_ranking_utils.modelling.model_factory import ModelFactory
 from search_ranking_utils.preprocessing.data_preprocessing import split_dataset
+from search_ranking_utils.preprocessing.preprocessor import Preprocessor
 from search_ranking_utils.modelling.models.popularity_baseline import (
     PopularityBaseline,
 )
@@ -55,3 +56,18 @@ def test_model_factory_fit(dummy_trainable_df, dummy_schema):
     )
     _, X, y = split_dataset(dummy_trainable_df, dummy_schema)
     model.fit(X, y)
+
+
+def test_model_factory_fit_sparse(dummy_df, dummy_schema):
+    model = ModelFactory.get_instance_from_config(
+        "sklearn.linear_model:LogisticRegression",
+        {"C": 0.5},
+    )
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    _, X, y = split_dataset(
+        preprocessor(dummy_df, sparse_output=True),
+        dummy_schema,
+        sparse_output=True,
+    )
+    model.fit(X, y)
+    assert model.predict_proba(X).shape == (7, 2)
@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from search_ranking_utils.preprocessing.data_preprocessing import (
     impute_df,
     normalise_numerical_features,
@@ -7,7 +9,11 @@ from search_ranking_utils.preprocessing.data_preprocessing import (
     one_hot_encode_categorical_features,
     drop_cols,
     split_dataset,
+    create_vocab_dtype,
+    get_category_codes,
+    hash_categories,
 )
+from search_ranking_utils.preprocessing.preprocessor import Preprocessor
 
 
 # Impute data using imputations
@@ -110,3 +116,82 @@ def test_split_dataset(dummy_trainable_df, dummy_schema):
     # Check y has the right values
     expected_y = pd.Series([1, 0, 0, 0, 1, 0, 0], name="interacted")
     pd.testing.assert_series_equal(expected_y, y)
+
+
+def test_one_hot_encode_categorical_features_sparse(dummy_df, dummy_schema):
+    df = map_oov_categories(dummy_df, dummy_schema)
+    encoder = create_one_hot_encoder(df, dummy_schema, sparse_output=True)
+    result = one_hot_encode_categorical_features(df, encoder)
+    assert isinstance(result["u_c_f_1_loyal"].dtype, pd.SparseDtype)
+    assert result.iloc[0]["u_c_f_1_loyal"] == 1
+    assert result.iloc[3]["p_c_f_2_food"] == 1
+
+
+def test_split_dataset_sparse(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    sparse_df = preprocessor(dummy_df, sparse_output=True)
+    df, X, y = split_dataset(sparse_df, dummy_schema, sparse_output=True)
+    assert sparse.isspmatrix_csr(X)
+    assert X.shape == (7, 7)
+    _, expected_X, expected_y = split_dataset(
+        preprocessor(dummy_df), dummy_schema
+    )
+    np.testing.assert_array_equal(expected_X.to_numpy(), X.toarray())
+    pd.testing.assert_series_equal(expected_y, y)
+
+
+def test_split_dataset_sparse_dense_input(dummy_df, dummy_schema):
+    dense_df = Preprocessor(dummy_df, dummy_schema)(dummy_df)
+    _, X, _ = split_dataset(dense_df, dummy_schema, sparse_output=True)
+    assert sparse.isspmatrix_csr(X)
+    _, expected_X, _ = split_dataset(dense_df, dummy_schema)
+    np.testing.assert_array_equal(expected_X.to_numpy(), X.toarray())
+
+
+def test_get_category_codes():
+    vocab_dtype = create_vocab_dtype(["food", "jacket", "~OTHER~"])
+    values = pd.Series(["jacket", "kids", None, "food"])
+    np.testing.assert_array_equal(
+        get_category_codes(values, vocab_dtype), [1, -1, -1, 0]
+    )
+    np.testing.assert_array_equal(
+        get_category_codes(values, vocab_dtype, oov_code=2), [1, 2, 2, 0]
+    )
+    # Already categorical values are recoded to the vocab
+    np.testing.assert_array_equal(
+        get_category_codes(values.astype("category"), vocab_dtype),
+        [1, -1, -1, 0],
+    )
+
+
+def test_map_oov_categories_does_not_modify_input(dummy_df, dummy_schema):
+    original = dummy_df.copy()
+    map_oov_categories(dummy_df, dummy_schema)
+    pd.testing.assert_frame_equal(original, dummy_df)
+
+
+def test_hash_categories():
+    values = pd.Series(["a", "b", "a", 123, "123"])
+    result = hash_categories(values, 16)
+    assert result.dtype == np.int64
+    assert ((result >= 0) & (result < 16)).all()
+    # Same string form gives the same bucket
+    assert result[0] == result[2]
+    assert result[3] == result[4]
+    np.testing.assert_array_equal(result, hash_categories(values, 16))
+
+
+def test_hash_categories_whole_floats():
+    # An int id column becomes float when a chunk has nulls
+    int_chunk = pd.Series([123, 456])
+    float_chunk = pd.Series([123, None, 456]).fillna(-1)
+    assert float_chunk.dtype == np.float64
+    expected = hash_categories(int_chunk, 2**20)
+    np.testing.assert_array_equal(
+        expected, hash_categories(float_chunk, 2**20)[[0, 2]]
+    )
+    # Raw records can mix types
+    np.testing.assert_array_equal(
+        expected, hash_categories([123.0, "456"], 2**20)
+    )
+    assert hash_categories([1.5], 16)[0] == hash_categories(["1.5"], 16)[0]
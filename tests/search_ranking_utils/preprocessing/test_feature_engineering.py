@@ -1,11 +1,20 @@
+import sys
 import time
 import logging
+import subprocess
 import pytest
 import numpy as np
+from search_ranking_utils.preprocessing.text_embedding import (
+    TextEmbedder,
+    ProductEmbeddingIndex,
+)
 from search_ranking_utils.preprocessing.feature_engineering import (
     calculate_text_cosine_similarity,
+    calculate_query_product_similarity,
     get_timestamp_part,
     calc_timestamp_part,
+    calc_timestamp_parts,
+    parse_timestamps,
 )
 
 logging.basicConfig(
@@ -14,6 +23,17 @@ logging.basicConfig(
 )
 
 
+def test_import_does_not_load_embedding_model():
+    # Run in a fresh interpreter, other tests may have loaded the model
+    code = (
+        "import sys\n"
+        "import search_ranking_utils.preprocessing.feature_engineering as fe\n"
+        "assert 'sentence_transformers' not in sys.modules\n"
+        "assert not fe.text_embedder.is_loaded\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
 def test_calculate_text_cosine_similarity(dummy_df):
     scores = calculate_text_cosine_similarity(
         dummy_df, "search_query", "product_title"
@@ -24,6 +44,83 @@ def test_calculate_text_cosine_similarity(dummy_df):
         assert score > -1 and score < 1
 
 
+@pytest.mark.parametrize(argnames="batch_size", argvalues=[1, 3, 100])
+def test_calculate_text_cosine_similarity_batched(
+    dummy_df, batch_size, tmp_path, counting_encoder_cls
+):
+    embedder = TextEmbedder(counting_encoder_cls())
+    expected = calculate_text_cosine_similarity(
+        dummy_df, "search_query", "product_title", embedder=embedder
+    )
+    result = calculate_text_cosine_similarity(
+        dummy_df,
+        "search_query",
+        "product_title",
+        embedder=embedder,
+        batch_size=batch_size,
+        embeddings_dir=str(tmp_path),
+    )
+    np.testing.assert_allclose(expected, result, rtol=1e-5)
+    stored = np.load(str(tmp_path / "search_query.npy"), mmap_mode="r")
+    assert stored.dtype == np.float16
+    assert stored.shape == (len(dummy_df), 4)
+    np.testing.assert_allclose(np.linalg.norm(stored, axis=1), 1, rtol=1e-3)
+
+
+def test_calculate_text_cosine_similarity_batched_empty(
+    dummy_df, tmp_path, counting_encoder_cls
+):
+    result = calculate_text_cosine_similarity(
+        dummy_df.iloc[:0],
+        "search_query",
+        "product_title",
+        embedder=TextEmbedder(counting_encoder_cls()),
+        embeddings_dir=str(tmp_path),
+    )
+    assert result.shape == (0,)
+
+
+def test_calculate_text_cosine_similarity_zero_embeddings(
+    dummy_df, counting_encoder_cls
+):
+    class ZeroEncoder(counting_encoder_cls):
+        def encode(self, texts) -> np.ndarray:
+            embeddings = super().encode(texts)
+            embeddings[np.asarray(texts) == "kids toys"] = 0
+            return embeddings
+
+    df = dummy_df.assign(search_query=["kids toys"] + ["a"] * 6)
+    embedder = TextEmbedder(ZeroEncoder())
+    expected = calculate_text_cosine_similarity(
+        df, "search_query", "product_title", embedder=embedder
+    )
+    result = calculate_text_cosine_similarity(
+        df, "search_query", "product_title", embedder=embedder, batch_size=2
+    )
+    # All zero embeddings have no similarity in either path
+    assert np.isnan(expected[0]) and np.isnan(result[0])
+    np.testing.assert_allclose(expected, result, rtol=1e-5)
+
+
+def test_calculate_query_product_similarity(
+    dummy_df, tmp_path, counting_encoder_cls
+):
+    embedder = TextEmbedder(counting_encoder_cls())
+    product_index = ProductEmbeddingIndex(str(tmp_path), embedder)
+    indexed = dummy_df.iloc[:4]
+    product_index.update(indexed["product_id"], indexed["product_title"])
+    result = calculate_query_product_similarity(
+        dummy_df, "search_query", product_index, embedder=embedder
+    )
+    expected = calculate_text_cosine_similarity(
+        dummy_df, "search_query", "product_title", embedder=embedder
+    )
+    # Products not in the index have no score
+    is_indexed = dummy_df["product_id"].isin(indexed["product_id"]).values
+    np.testing.assert_allclose(expected[is_indexed], result[is_indexed], 1e-5)
+    assert np.isnan(result[~is_indexed]).all()
+
+
 def test_calculate_text_cosine_similarity_inference_time(dummy_df):
     NUM_INFERENCES = 15000
     THRESHOLD_SECONDS = 30
@@ -64,3 +161,33 @@ def test_get_timestamp_part(timestamp_str, timestamp_part, expected):
 def test_calc_timestamp_part(dummy_df, timestamp_part, expected):
     result = calc_timestamp_part(dummy_df, timestamp_part)
     np.testing.assert_array_equal(expected, result)
+
+
+def test_calc_timestamp_parts(dummy_df):
+    result = calc_timestamp_parts(dummy_df, ["hour", "weekday", "second"])
+    assert result.dtype == np.int64
+    for i, part in enumerate(["hour", "weekday", "second"]):
+        np.testing.assert_array_equal(
+            calc_timestamp_part(dummy_df, part), result[:, i]
+        )
+    # Already parsed timestamps give the same result
+    parsed_df = dummy_df.assign(
+        local_timestamp=parse_timestamps(dummy_df["local_timestamp"])
+    )
+    np.testing.assert_array_equal(
+        result, calc_timestamp_parts(parsed_df, ["hour", "weekday", "second"])
+    )
+
+
+def test_calc_timestamp_parts_cyclical(dummy_df):
+    result = calc_timestamp_parts(dummy_df, ["hour"], cyclical=True)
+    assert result.shape == (len(dummy_df), 3)
+    np.testing.assert_array_equal(result[:, 0], [8, 8, 8, 17, 17, 17, 17])
+    np.testing.assert_allclose(
+        result[:, 1], np.sin(2 * np.pi * result[:, 0] / 24)
+    )
+    np.testing.assert_allclose(
+        result[:, 2], np.cos(2 * np.pi * result[:, 0] / 24)
+    )
+    with pytest.raises(ValueError):
+        calc_timestamp_parts(dummy_df, ["year"], cyclical=True)
@@ -1,4 +1,8 @@
-from sklearn.preprocessing import OneHotEncoder
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
 from search_ranking_utils.utils.testing import assert_dicts_equal
 from search_ranking_utils.preprocessing.preprocessor import Preprocessor
 
@@ -22,7 +26,8 @@ def test_preprocessor_init(dummy_df, dummy_schema):
         preprocessor.schema.norm_stats,
     )
 
-    assert isinstance(preprocessor.one_hot_encoder, OneHotEncoder)
+    # The training data isn't kept
+    assert not hasattr(preprocessor, "base_df")
 
 
 def test_preprocessor_call(dummy_df, dummy_schema):
@@ -45,3 +50,229 @@ def test_preprocessor_call(dummy_df, dummy_schema):
     # Check if old categorical columns are dropped
     assert "u_c_f_1" not in result.columns
     assert "p_c_f_2" not in result.columns
+
+
+def test_preprocessor_fit_transform(dummy_df, dummy_schema_dict):
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    preprocessor = Preprocessor(None, schema)
+    with pytest.raises(NotImplementedError):
+        preprocessor.transform(dummy_df)
+    assert preprocessor.fit(dummy_df) is preprocessor
+    expected = Preprocessor(dummy_df, schema)(dummy_df)
+    pd.testing.assert_frame_equal(expected, preprocessor.transform(dummy_df))
+
+
+def test_preprocessor_init_keeps_schema_stats(dummy_df, dummy_schema_dict):
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    schema.set_stats(dummy_df.head(3))
+    imputations = dict(schema.imputations)
+    # Stats already on the schema aren't overwritten by base_df
+    preprocessor = Preprocessor(dummy_df, schema)
+    assert_dicts_equal(imputations, preprocessor.schema.imputations)
+    # Only an explicit fit refits
+    preprocessor.fit(dummy_df)
+    assert preprocessor.schema.imputations["u_n_f_2"] == -500.5
+
+
+def test_preprocessor_transform_array(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    result = preprocessor.transform_array(dummy_df)
+    assert result.dtype == np.float32
+    assert preprocessor.feature_names == dummy_schema.get_model_features()
+    np.testing.assert_allclose(
+        preprocessor(dummy_df)[preprocessor.feature_names].to_numpy(),
+        result,
+        rtol=1e-6,
+    )
+
+
+def test_preprocessor_call_column_order(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    ohe_cols = preprocessor.feature_names[2:]
+    assert (
+        list(preprocessor(dummy_df).columns)
+        == [
+            "u_n_f_2",
+            "p_n_f_1",
+            "interacted",
+            "query_id",
+        ]
+        + ohe_cols
+    )
+    # Numerical features stay in place, categorical features are dropped
+    result = preprocessor(dummy_df, drop_redundant=False)
+    expected_cols = [
+        c for c in dummy_df.columns if c not in ["u_c_f_1", "p_c_f_2"]
+    ]
+    assert list(result.columns) == expected_cols + ohe_cols
+
+
+def test_preprocessor_call_imputes_kept_columns(dummy_df, dummy_schema_dict):
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    preprocessor = Preprocessor(dummy_df, schema)
+    df = dummy_df.copy()
+    df.loc[0, "interacted"] = np.nan
+    # Only columns with an imputation are filled
+    assert np.isnan(preprocessor(df)["interacted"].iloc[0])
+    schema.imputations["interacted"] = 0
+    assert preprocessor(df)["interacted"].iloc[0] == 0
+
+
+def test_preprocessor_call_keep_redundant(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    result = preprocessor(dummy_df, drop_redundant=False)
+    # Non feature columns are kept as they are
+    assert (result["product_id"] == dummy_df["product_id"]).all()
+    assert "u_c_f_1" not in result.columns
+    assert "u_n_f_1" in result.columns
+
+
+def test_preprocessor_transform_chunks(dummy_df, dummy_schema, dummy_csv_path):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    chunks = pd.read_csv(dummy_csv_path, chunksize=3)
+    result = pd.concat(preprocessor.transform_chunks(chunks))
+    pd.testing.assert_frame_equal(preprocessor(dummy_df), result)
+
+
+def test_preprocessor_write_chunks_npy(
+    dummy_df, dummy_schema, dummy_csv_path, tmp_path
+):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    chunks = pd.read_csv(dummy_csv_path, chunksize=3)
+    paths = preprocessor.write_chunks(chunks, tmp_path, shard_format="npy")
+    # Features and target for 3 chunks
+    assert len(paths) == 6
+    features = np.concatenate([np.load(p) for p in paths[::2]])
+    target = np.concatenate([np.load(p) for p in paths[1::2]])
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df), features
+    )
+    np.testing.assert_array_equal(dummy_df["interacted"], target)
+
+
+def test_preprocessor_write_chunks_parquet(
+    dummy_df, dummy_schema, dummy_csv_path, tmp_path
+):
+    pytest.importorskip("pyarrow")
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    chunks = pd.read_csv(dummy_csv_path, chunksize=3)
+    paths = preprocessor.write_chunks(chunks, tmp_path)
+    result = pd.concat([pd.read_parquet(p) for p in paths])
+    pd.testing.assert_frame_equal(preprocessor(dummy_df), result)
+
+
+def test_preprocessor_write_chunks_invalid_format(
+    dummy_df, dummy_schema, tmp_path
+):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    with pytest.raises(ValueError):
+        preprocessor.write_chunks([dummy_df], tmp_path, shard_format="csv")
+
+
+def test_preprocessor_save_load(dummy_df, dummy_schema, tmp_path):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    preprocessor.save(str(tmp_path))
+    loaded = Preprocessor.load(str(tmp_path))
+    assert loaded.feature_names == preprocessor.feature_names
+    assert_dicts_equal(
+        preprocessor.schema.imputations, loaded.schema.imputations
+    )
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df),
+        loaded.transform_array(dummy_df),
+    )
+    pd.testing.assert_frame_equal(preprocessor(dummy_df), loaded(dummy_df))
+
+
+@pytest.mark.parametrize(argnames="dtype", argvalues=["Int64", "float64"])
+def test_preprocessor_save_load_non_string_categories(
+    dummy_df, dummy_schema_dict, tmp_path, dtype
+):
+    df = dummy_df.copy()
+    df["u_c_f_1"] = df["u_c_f_1"].map({"loyal": 1, "infrequent": 2})
+    df["u_c_f_1"] = df["u_c_f_1"].astype(dtype)
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    preprocessor = Preprocessor(df, schema)
+    preprocessor.save(str(tmp_path))
+    loaded = Preprocessor.load(str(tmp_path))
+    assert loaded.schema.vocabs["u_c_f_1"] == [1, 2]
+    assert loaded.schema.imputations["u_c_f_1"] == 1
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(df), loaded.transform_array(df)
+    )
+
+
+def test_preprocessor_save_mixed_type_vocab(
+    dummy_df, dummy_schema_dict, tmp_path
+):
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    schema.set_stats(dummy_df)
+    # Would be saved as strings, so 1 would never match again
+    schema.vocabs["u_c_f_1"] = [1, "loyal"]
+    with pytest.raises(ValueError):
+        Preprocessor(None, schema).save(str(tmp_path))
+
+
+def test_preprocessor_load_invalid_version(dummy_df, dummy_schema, tmp_path):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    preprocessor.ARTIFACT_VERSION = 0
+    preprocessor.save(str(tmp_path))
+    with pytest.raises(ValueError):
+        Preprocessor.load(str(tmp_path))
+
+
+@pytest.mark.parametrize(argnames="n_jobs", argvalues=[1, 2, 3])
+def test_preprocessor_transform_parallel(dummy_df, dummy_schema, n_jobs):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    result = preprocessor.transform_parallel(dummy_df, n_jobs=n_jobs)
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df), result
+    )
+
+
+@pytest.mark.parametrize(argnames="n_jobs", argvalues=[1, 2, -1])
+def test_preprocessor_transform_parallel_memmap_out(
+    dummy_df, dummy_schema, tmp_path, n_jobs
+):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    path = str(tmp_path / "features.npy")
+    out = np.lib.format.open_memmap(
+        path,
+        mode="w+",
+        dtype=np.float64,
+        shape=(len(dummy_df), len(preprocessor.feature_names)),
+    )
+    result = preprocessor.transform_parallel(dummy_df, n_jobs=n_jobs, out=out)
+    assert result is out
+    expected = preprocessor.transform_array(dummy_df, dtype=np.float64)
+    np.testing.assert_array_equal(expected, result)
+    np.testing.assert_array_equal(expected, np.load(path))
+
+
+def test_preprocessor_transform_parallel_invalid_args(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    with pytest.raises(ValueError):
+        preprocessor.transform_parallel(dummy_df, n_jobs=0)
+    # Workers can't write into a normal array
+    out = np.zeros((len(dummy_df), len(preprocessor.feature_names)))
+    with pytest.raises(ValueError):
+        preprocessor.transform_parallel(dummy_df, n_jobs=2, out=out)
+
+
+def test_preprocessor_transform_parallel_executor(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        result = preprocessor.transform_parallel(
+            dummy_df, n_jobs=2, dtype=np.float64, executor=executor
+        )
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df, dtype=np.float64), result
+    )
+
+
+def test_preprocessor_transform_records(dummy_df, dummy_schema):
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    result = preprocessor.transform_records(dummy_df.to_dict("records"))
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df), result
+    )
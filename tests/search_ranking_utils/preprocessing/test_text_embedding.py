@@ -0,0 +1,179 @@
+import pytest
+import numpy as np
+from search_ranking_utils.preprocessing.text_embedding import (
+    EmbeddingCache,
+    EmbeddingStore,
+    TextEmbedder,
+    ProductEmbeddingIndex,
+    PipelinedEncoder,
+)
+
+
+@pytest.fixture
+def texts(dummy_df) -> np.ndarray:
+    return dummy_df["search_query"].values
+
+
+def test_embedding_cache_evicts_least_recent():
+    cache = EmbeddingCache(max_size=2)
+    cache.put("a", np.zeros(2))
+    cache.put("b", np.ones(2))
+    cache.get("a")
+    cache.put("c", np.ones(2))
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+
+def test_text_embedder_deduplicates(texts, counting_encoder_cls):
+    encoder = counting_encoder_cls()
+    embedder = TextEmbedder(encoder)
+    result = embedder.embed(texts)
+    assert result.shape == (len(texts), 4)
+    # Each distinct text is only encoded once
+    assert sorted(encoder.encoded) == sorted(set(texts))
+    np.testing.assert_array_equal(encoder.encode(list(texts)), result)
+    # Cached texts aren't encoded again
+    encoder.encoded = []
+    embedder.embed(texts)
+    assert encoder.encoded == []
+
+
+def test_embedding_store_put_lookup(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=2, initial_capacity=1)
+    rows = store.put(np.array([5, 7, 9]), np.arange(6).reshape(3, 2))
+    np.testing.assert_array_equal(rows, [0, 1, 2])
+    np.testing.assert_array_equal(store.lookup([9, 1]), [2, -1])
+    # Existing keys are overwritten in place
+    store.put(np.array([7]), np.array([[10, 11]]))
+    store.flush()
+    reloaded = EmbeddingStore(str(tmp_path), dim=2)
+    assert len(reloaded) == 3
+    np.testing.assert_array_equal(reloaded.get([1, 2]), [[10, 11], [4, 5]])
+
+
+def test_embedding_store_appends_without_rebuilding(tmp_path):
+    store = EmbeddingStore(str(tmp_path), dim=2, initial_capacity=1)
+    store.put(np.arange(4), np.zeros((4, 2)))
+    index = store.index
+    # New keys are found before the index is rebuilt
+    rows = store.put(np.array([10, 11]), np.ones((2, 2)))
+    assert store.index is index
+    np.testing.assert_array_equal(store.lookup([11, 3, 12]), [5, 3, -1])
+    np.testing.assert_array_equal(store.keys, [0, 1, 2, 3, 10, 11])
+    # Overwriting a new key keeps its row
+    np.testing.assert_array_equal(
+        store.put(np.array([10]), np.full((1, 2), 2)), rows[:1]
+    )
+    assert len(store) == 6
+    store.flush()
+    reloaded = EmbeddingStore(str(tmp_path))
+    np.testing.assert_array_equal(reloaded.lookup([10, 11]), [4, 5])
+    np.testing.assert_array_equal(reloaded.get([4]), [[2, 2]])
+
+
+def test_text_embedder_store(texts, tmp_path, counting_encoder_cls):
+    store = EmbeddingStore(str(tmp_path), dim=4)
+    embedder = TextEmbedder(counting_encoder_cls(), store=store)
+    expected = embedder.embed(texts)
+    # Nothing is written until flushed
+    assert len(EmbeddingStore(str(tmp_path))) == 0
+    embedder.flush()
+    # A new process, with an empty cache, reads from the store
+    encoder = counting_encoder_cls()
+    embedder = TextEmbedder(
+        encoder, store=EmbeddingStore(str(tmp_path), dim=4)
+    )
+    np.testing.assert_array_equal(expected, embedder.embed(texts))
+    assert encoder.encoded == []
+
+
+def test_text_embedder_warm_up(texts, counting_encoder_cls):
+    encoder = counting_encoder_cls()
+    embedder = TextEmbedder(encoder)
+    embedder.warm_up()
+    assert encoder.encoded == ["warm up"]
+    # Warming up doesn't cache anything
+    assert len(embedder.cache) == 0
+
+
+def test_text_embedder_requires_encoder_or_model_name():
+    with pytest.raises(ValueError):
+        TextEmbedder()
+    assert not TextEmbedder(model_name="msmarco-MiniLM-L-6-v3").is_loaded
+
+
+def test_text_embedder_normalise(texts, counting_encoder_cls):
+    embedder = TextEmbedder(counting_encoder_cls())
+    result = embedder.embed(texts, normalise=True)
+    np.testing.assert_allclose(np.linalg.norm(result, axis=1), 1, rtol=1e-6)
+    expected = embedder.embed(texts)
+    np.testing.assert_allclose(
+        expected / np.linalg.norm(expected, axis=1, keepdims=True), result
+    )
+
+
+def test_product_embedding_index_update(
+    dummy_df, tmp_path, counting_encoder_cls
+):
+    encoder = counting_encoder_cls()
+    index = ProductEmbeddingIndex(str(tmp_path), TextEmbedder(encoder))
+    num_updated = index.update(
+        dummy_df["product_id"], dummy_df["product_title"]
+    )
+    assert num_updated == dummy_df["product_id"].nunique() == len(index)
+    # Unchanged products aren't embedded again, even after reloading
+    encoder.encoded = []
+    index = ProductEmbeddingIndex(str(tmp_path), TextEmbedder(encoder))
+    products = dummy_df.drop_duplicates("product_id")
+    assert index.update(products["product_id"], products["product_title"]) == 0
+    assert encoder.encoded == []
+    # Only new or changed products are embedded
+    assert index.update(["prod1", "new"], ["changed", "new title"]) == 2
+    assert sorted(encoder.encoded) == ["changed", "new title"]
+    rows = index.lookup(["prod1", "new", "missing"])
+    assert rows[2] == -1
+    expected = TextEmbedder(counting_encoder_cls()).embed(
+        ["changed", "new title"], normalise=True
+    )
+    np.testing.assert_allclose(expected, index.get(rows[:2]), rtol=1e-6)
+
+
+@pytest.mark.parametrize(
+    argnames=["num_workers", "batch_size"],
+    argvalues=[(1, 1), (2, 3), (3, 100)],
+)
+def test_pipelined_encoder(
+    texts, num_workers, batch_size, counting_encoder_cls
+):
+    encoder = counting_encoder_cls()
+    batches = []
+
+    def infer(batch):
+        batches.append(batch)
+        return encoder.encode(batch)
+
+    pipelined = PipelinedEncoder(
+        tokenize_fn=list,
+        infer_fn=infer,
+        num_workers=num_workers,
+        queue_depth=1,
+        batch_size=batch_size,
+    )
+    texts = list(texts) + ["a much longer search query than the others"]
+    result = pipelined.encode(texts)
+    np.testing.assert_array_equal(counting_encoder_cls().encode(texts), result)
+    # Batches are bucketed by length
+    assert len(batches) == int(np.ceil(len(texts) / batch_size))
+    lengths = sorted([[len(t) for t in batch] for batch in batches])
+    for shorter, longer in zip(lengths[:-1], lengths[1:]):
+        assert max(shorter) <= min(longer)
+
+
+def test_pipelined_encoder_raises_errors(texts):
+    def infer(batch):
+        raise RuntimeError("inference failed")
+
+    pipelined = PipelinedEncoder(list, infer, num_workers=2, batch_size=1)
+    with pytest.raises(RuntimeError):
+        pipelined.encode(texts)
@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from search_ranking_utils.preprocessing.data_preprocessing import (
+    impute_df,
+    normalise_numerical_features,
+    map_oov_categories,
+    create_one_hot_encoder,
+    one_hot_encode_categorical_features,
+)
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.preprocessing.transform_plan import (
+    TransformPlan,
+    HashedStep,
+)
+
+
+@pytest.fixture
+def dummy_plan(dummy_schema) -> TransformPlan:
+    return TransformPlan.create_instance_from_schema(dummy_schema)
+
+
+def test_transform_plan_create_instance_from_schema(dummy_plan, dummy_schema):
+    assert dummy_plan.feature_names == dummy_schema.get_model_features()
+    assert [step.column for step in dummy_plan.numerical_steps] == [0, 1]
+    assert [step.start for step in dummy_plan.categorical_steps] == [2, 4]
+    # Only the capped feature maps unknown categories to OOV
+    assert dummy_plan.categorical_steps[0].oov_index is None
+    assert dummy_plan.categorical_steps[1].oov_index == 2
+
+
+def test_transform_plan_transform(dummy_plan, dummy_df, dummy_schema):
+    result = dummy_plan.transform(dummy_df, dtype=np.float64)
+    # Same result as running each step separately
+    df = impute_df(dummy_df, dummy_schema.imputations)
+    df = normalise_numerical_features(df, dummy_schema.norm_stats)
+    df = map_oov_categories(df, dummy_schema)
+    encoder = create_one_hot_encoder(df, dummy_schema)
+    expected = one_hot_encode_categorical_features(df, encoder)
+    np.testing.assert_array_equal(
+        expected[dummy_schema.get_model_features()].to_numpy(), result
+    )
+
+
+def test_transform_plan_transform_float32(dummy_plan, dummy_df):
+    result = dummy_plan.transform(dummy_df)
+    assert result.dtype == np.float32
+    assert result.shape == (7, 7)
+    assert result.flags["C_CONTIGUOUS"]
+    # Each categorical feature has exactly one hot column per row
+    np.testing.assert_array_equal(result[:, 2:4].sum(axis=1), 1)
+    np.testing.assert_array_equal(result[:, 4:].sum(axis=1), 1)
+
+
+def test_transform_plan_transform_unknown_category(dummy_plan, dummy_df):
+    df = dummy_df.head(2).assign(u_c_f_1="new", p_c_f_2="new")
+    result = dummy_plan.to_frame(dummy_plan.transform(df))
+    # Uncapped feature has no hot column, capped feature goes to OOV
+    assert (result[["u_c_f_1_infrequent", "u_c_f_1_loyal"]] == 0).all().all()
+    assert (result["p_c_f_2_~OTHER~"] == 1).all()
+
+
+def test_transform_plan_to_frame(dummy_plan, dummy_df):
+    arr = dummy_plan.transform(dummy_df)
+    result = dummy_plan.to_frame(arr, index=dummy_df.index)
+    assert isinstance(result, pd.DataFrame)
+    assert list(result.columns) == dummy_plan.feature_names
+    assert np.shares_memory(result.to_numpy(), arr)
+
+
+def test_transform_plan_transform_sparse(dummy_plan, dummy_df):
+    result = dummy_plan.transform_sparse(dummy_df)
+    assert sparse.isspmatrix_csr(result)
+    assert result.dtype == np.float32
+    # 2 numerical and 2 one hot values per row
+    assert result.nnz == 7 * 4
+    np.testing.assert_array_equal(
+        dummy_plan.transform(dummy_df), result.toarray()
+    )
+
+
+@pytest.fixture
+def hashed_plan(dummy_df, dummy_schema_dict) -> TransformPlan:
+    schema_dict = {
+        **dummy_schema_dict,
+        "features": {
+            **dummy_schema_dict["features"],
+            "categorical": {
+                "p_c_f_2": {
+                    "impute": {"impute_type": "mode"},
+                    "hash_buckets": 8,
+                }
+            },
+        },
+    }
+    schema = Schema.create_instance_from_dict(schema_dict)
+    schema.set_stats(dummy_df)
+    return TransformPlan.create_instance_from_schema(schema)
+
+
+def test_transform_plan_hashed(hashed_plan, dummy_df):
+    step = hashed_plan.categorical_steps[0]
+    assert isinstance(step, HashedStep)
+    assert hashed_plan.feature_names[2:] == [
+        f"p_c_f_2_hash_{i}" for i in range(8)
+    ]
+    result = hashed_plan.transform(dummy_df)
+    assert result.shape == (7, 10)
+    np.testing.assert_array_equal(result[:, 2:].sum(axis=1), 1)
+    # New categories still get a bucket, without refitting
+    new = hashed_plan.transform(dummy_df.head(2).assign(p_c_f_2="new"))
+    np.testing.assert_array_equal(new[:, 2:].sum(axis=1), 1)
+    np.testing.assert_array_equal(
+        result, hashed_plan.transform_sparse(dummy_df).toarray()
+    )
+
+
+def test_transform_plan_transform_records(dummy_plan, dummy_df):
+    expected = dummy_plan.transform(dummy_df)
+    records = dummy_df.to_dict("records")
+    np.testing.assert_array_equal(
+        expected, dummy_plan.transform_records(records)
+    )
+    np.testing.assert_array_equal(
+        expected, dummy_plan.transform_records(dummy_df.to_dict("list"))
+    )
+    # Missing keys are imputed, unknown categories follow transform
+    new = [{"u_c_f_1": "new", "p_c_f_2": "new"}, {}]
+    df = pd.DataFrame(new, columns=dummy_plan.input_features)
+    np.testing.assert_array_equal(
+        dummy_plan.transform(df), dummy_plan.transform_records(new)
+    )
+
+
+def test_transform_plan_transform_records_columns(dummy_plan):
+    # Missing feature columns are null, other columns don't set the rows
+    columns = {"request_id": ["r1"], "u_c_f_1": ["loyal", None]}
+    df = pd.DataFrame(
+        {"u_c_f_1": ["loyal", None]}, columns=dummy_plan.input_features
+    )
+    np.testing.assert_array_equal(
+        dummy_plan.transform(df), dummy_plan.transform_records(columns)
+    )
+    with pytest.raises(ValueError):
+        dummy_plan.transform_records({"u_c_f_1": ["a"], "u_n_f_2": [1, 2]})
+
+
+def test_transform_plan_hashed_records(hashed_plan, dummy_df):
+    np.testing.assert_array_equal(
+        hashed_plan.transform(dummy_df),
+        hashed_plan.transform_records(dummy_df.to_dict("records")),
+    )
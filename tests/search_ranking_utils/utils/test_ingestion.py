@@ -0,0 +1,119 @@
+import copy
+import pytest
+import numpy as np
+import pandas as pd
+
+pytest.importorskip("pyarrow")
+
+from search_ranking_utils.utils.ingestion import (  # noqa: E402
+    read_dataset,
+    iter_dataset_batches,
+)
+from search_ranking_utils.utils.schema import Schema  # noqa: E402
+from search_ranking_utils.utils.testing import assert_dicts_equal  # noqa: E402
+from search_ranking_utils.preprocessing.preprocessor import (  # noqa: E402
+    Preprocessor,
+)
+
+
+@pytest.fixture
+def dummy_parquet_path(dummy_df, tmp_path) -> str:
+    path = str(tmp_path / "dummy.parquet")
+    dummy_df.to_parquet(path, row_group_size=3)
+    return path
+
+
+def test_read_dataset(dummy_parquet_path, dummy_df, dummy_schema):
+    result = read_dataset(dummy_parquet_path, dummy_schema)
+    # Only the schema columns are read
+    assert list(result.columns) == dummy_schema.get_columns()
+    assert "product_description" not in result.columns
+    assert isinstance(result["p_c_f_2"].dtype, pd.CategoricalDtype)
+    preprocessor = Preprocessor(dummy_df, dummy_schema)
+    np.testing.assert_array_equal(
+        preprocessor.transform_array(dummy_df),
+        preprocessor.transform_array(result),
+    )
+
+
+def test_read_dataset_set_stats(
+    dummy_parquet_path, dummy_schema, dummy_schema_dict
+):
+    # Categorical columns give the same stats as the raw data
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    schema.set_stats(read_dataset(dummy_parquet_path, schema))
+    assert_dicts_equal(dummy_schema.imputations, schema.imputations)
+    assert_dicts_equal(dummy_schema.vocabs, schema.vocabs)
+
+
+def test_read_dataset_filters(dummy_parquet_path, dummy_schema):
+    result = read_dataset(
+        dummy_parquet_path,
+        dummy_schema,
+        filters=[("query_id", "=", "query1")],
+        extra_cols=["product_id"],
+    )
+    assert (result["query_id"] == "query1").all()
+    assert len(result) == 3
+    assert "product_id" in result.columns
+
+
+def test_read_dataset_csv(dummy_csv_path, dummy_schema):
+    result = read_dataset(dummy_csv_path, dummy_schema, file_format="csv")
+    assert list(result.columns) == dummy_schema.get_columns()
+    assert isinstance(result["u_c_f_1"].dtype, pd.CategoricalDtype)
+
+
+def test_iter_dataset_batches(dummy_parquet_path, dummy_schema):
+    batches = list(
+        iter_dataset_batches(dummy_parquet_path, dummy_schema, batch_size=2)
+    )
+    assert max(len(batch) for batch in batches) <= 2
+    result = pd.concat(batches, ignore_index=True)
+    expected = read_dataset(dummy_parquet_path, dummy_schema)
+    pd.testing.assert_frame_equal(
+        expected.astype(str), result.astype(str), check_dtype=False
+    )
+
+
+def test_iter_dataset_batches_unified_categories(
+    dummy_parquet_path, dummy_schema
+):
+    batches = list(
+        iter_dataset_batches(dummy_parquet_path, dummy_schema, batch_size=2)
+    )
+    categories = [batch["p_c_f_2"].cat.categories for batch in batches]
+    # Each batch only adds categories, so codes keep their meaning
+    for previous, current in zip(categories[:-1], categories[1:]):
+        assert list(current[: len(previous)]) == list(previous)
+    codes = np.concatenate([batch["p_c_f_2"].cat.codes for batch in batches])
+    expected = read_dataset(dummy_parquet_path, dummy_schema)["p_c_f_2"]
+    result = pd.Categorical.from_codes(codes, categories=categories[-1])
+    pd.testing.assert_series_equal(
+        expected.astype(object),
+        pd.Series(result, name="p_c_f_2").astype(object),
+    )
+
+
+def test_iter_dataset_batches_hashed_null_first_batch(
+    dummy_df, dummy_schema_dict, tmp_path
+):
+    schema_dict = copy.deepcopy(dummy_schema_dict)
+    schema_dict["features"]["categorical"]["p_c_f_2"] = {
+        "impute": {"impute_type": "mode"},
+        "hash_buckets": 8,
+    }
+    schema = Schema.create_instance_from_dict(schema_dict)
+    schema.set_stats(dummy_df)
+    # The first batch has no categories for the hashed feature
+    df = dummy_df.copy()
+    df.loc[:1, "p_c_f_2"] = None
+    path = str(tmp_path / "nulls.parquet")
+    df.to_parquet(path, row_group_size=2)
+    preprocessor = Preprocessor(None, schema)
+    batches = list(iter_dataset_batches(path, schema, batch_size=2))
+    assert len(batches[0]["p_c_f_2"].cat.categories) == 0
+    result = np.concatenate(
+        [preprocessor.transform_array(batch) for batch in batches]
+    )
+    np.testing.assert_array_equal(preprocessor.transform_array(df), result)
@@ -0,0 +1,82 @@
+import pytest
+import numpy as np
+from search_ranking_utils.utils.query_index import QueryIndex
+
+
+@pytest.fixture
+def dummy_query_index(dummy_df, dummy_schema) -> QueryIndex:
+    return QueryIndex.create_instance_from_df(dummy_df, dummy_schema)
+
+
+def test_query_index_create_instance_from_df(dummy_query_index):
+    assert dummy_query_index.num_queries == 2
+    assert dummy_query_index.num_rows == 7
+    np.testing.assert_array_equal(dummy_query_index.offsets, [0, 3, 7])
+    np.testing.assert_array_equal(dummy_query_index.sizes, [3, 4])
+    assert list(dummy_query_index.queries) == ["query1", "query2"]
+
+
+def test_query_index_gather():
+    query_index = QueryIndex.create_instance_from_values(
+        np.array(["b", "a", "b", "a"])
+    )
+    np.testing.assert_array_equal(query_index.order, [1, 3, 0, 2])
+    np.testing.assert_array_equal(
+        query_index.gather(np.array([10, 20, 30, 40])), [20, 40, 10, 30]
+    )
+    with pytest.raises(ValueError):
+        query_index.gather(np.array([1, 2]))
+
+
+def test_query_index_filters():
+    query_index = QueryIndex.create_instance_from_values(
+        np.array(["a", "b", "b", "c", "c"])
+    )
+    y_true = np.array([1, 1, 0, 0, 0])
+    filtered = query_index.filter_small_queries(
+        min_size=2
+    ).filter_queries_without_positives(y_true)
+    assert list(filtered.queries) == ["b"]
+    np.testing.assert_array_equal(filtered.order, [1, 2])
+    np.testing.assert_array_equal(filtered.offsets, [0, 2])
+
+
+@pytest.mark.parametrize(
+    argnames=["aggregation", "expected"],
+    argvalues=[
+        ("sum", [3.0, 12.0]),
+        ("mean", [1.5, 4.0]),
+        ("min", [1.0, 3.0]),
+        ("max", [2.0, 5.0]),
+        ("size", [2, 3]),
+    ],
+)
+def test_query_index_aggregate(aggregation, expected):
+    query_index = QueryIndex.create_instance_from_values(
+        np.array(["a", "b", "a", "b", "b"])
+    )
+    values = np.array([1.0, 3.0, 2.0, 4.0, 5.0])
+    np.testing.assert_array_equal(
+        query_index.aggregate(values, aggregation), expected
+    )
+
+
+def test_query_index_transform():
+    query_index = QueryIndex.create_instance_from_values(
+        np.array(["a", "b", "a", "b", "b"])
+    )
+    values = np.array([1.0, 3.0, 2.0, 4.0, 5.0])
+    np.testing.assert_array_equal(
+        query_index.transform(values, "mean"), [1.5, 4.0, 1.5, 4.0, 4.0]
+    )
+    # Rows of filtered out queries have no value
+    filtered = query_index.filter_queries(np.array([False, True]))
+    np.testing.assert_array_equal(
+        filtered.transform(values, "max"),
+        [np.nan, 5.0, np.nan, 5.0, 5.0],
+    )
+
+
+def test_query_index_invalid_aggregation(dummy_query_index, dummy_df):
+    with pytest.raises(ValueError):
+        dummy_query_index.aggregate(dummy_df["p_n_f_1"], "median")
@@ -1,3 +1,8 @@
+import pytest
+from search_ranking_utils.utils.schema import (
+    CategoricalFeature,
+    ImputeStrategy,
+)
 from search_ranking_utils.utils.testing import assert_dicts_equal
 
 
@@ -15,6 +20,10 @@ def test_schema_create_instance_from_dict(dummy_schema):
     assert dummy_schema.query_col == "query_id"
 
 
+def test_schema_to_dict(dummy_schema, dummy_schema_dict):
+    assert dummy_schema.to_dict() == dummy_schema_dict
+
+
 def test_set_imputations(dummy_df, dummy_schema):
     dummy_schema.set_imputations(dummy_df)
     expected = {
@@ -46,3 +55,22 @@ def test_set_vocabs(dummy_df, dummy_schema):
         ],
     }
     assert_dicts_equal(expected, dummy_schema.vocabs)
+
+
+def test_categorical_feature_hash_buckets():
+    f = CategoricalFeature.get_instance_from_config(
+        "product_id", {"impute": {"impute_type": "mode"}, "hash_buckets": 3}
+    )
+    assert f.get_bucket_names() == [
+        "product_id_hash_0",
+        "product_id_hash_1",
+        "product_id_hash_2",
+    ]
+    assert f.to_config()["hash_buckets"] == 3
+    with pytest.raises(ValueError):
+        CategoricalFeature(
+            "product_id",
+            ImputeStrategy("mode"),
+            max_categories=2,
+            hash_buckets=3,
+        )
@@ -0,0 +1,110 @@
+import pytest
+import numpy as np
+import pandas as pd
+from search_ranking_utils.utils.sketches import (
+    RunningMoments,
+    QuantileSketch,
+    FrequentItemsSketch,
+)
+
+
+def test_running_moments():
+    rng = np.random.default_rng(0)
+    values = rng.normal(loc=5.0, scale=2.0, size=10000)
+    values[::100] = np.nan
+    moments = RunningMoments()
+    for chunk in np.array_split(values, 7):
+        moments.update(chunk)
+    expected = pd.Series(values)
+    assert moments.count == expected.count()
+    assert moments.mean == pytest.approx(expected.mean())
+    assert moments.std == pytest.approx(expected.std())
+    assert moments.min == expected.min()
+    assert moments.max == expected.max()
+
+
+def test_quantile_sketch_exact_before_compaction():
+    sketch = QuantileSketch(k=200)
+    sketch.update(np.array([5.0, 1.0, np.nan, 3.0]))
+    sketch.update(np.array([2.0]))
+    assert sketch.count == 4
+    assert sketch.quantile(0.5) == 2.5
+
+
+def test_quantile_sketch_error_bound():
+    rng = np.random.default_rng(0)
+    values = rng.exponential(size=200000)
+    sketch = QuantileSketch(k=200, seed=0)
+    for chunk in np.array_split(values, 20):
+        sketch.update(chunk)
+    # Memory stays small
+    assert sum(len(level) for level in sketch.levels) < 1000
+    for q in [0.1, 0.5, 0.9]:
+        rank = (values < sketch.quantile(q)).mean()
+        assert abs(rank - q) < 0.02
+
+
+def test_frequent_items_sketch_exact():
+    sketch = FrequentItemsSketch()
+    sketch.update(pd.Series(["b", "a", None, "a", "c", "b"]))
+    assert not sketch.approximate
+    assert list(sketch.most_common().index) == ["a", "b", "c"]
+    # Ties go to the smallest value
+    assert sketch.mode() == "a"
+
+
+def test_frequent_items_sketch_error_bound():
+    rng = np.random.default_rng(0)
+    values = pd.Series(rng.zipf(1.5, 100000))
+    sketch = FrequentItemsSketch(capacity=50)
+    for chunk in np.array_split(values, 10):
+        sketch.update(chunk)
+    assert sketch.approximate
+    assert len(sketch.counts) <= 50
+    expected = values.value_counts()
+    for item, count in sketch.most_common(5).items():
+        assert expected[item] - sketch.error_bound <= count <= expected[item]
+    assert sketch.mode() == expected.index[0]
+
+
+def test_running_moments_merge():
+    values = np.arange(100, dtype=float)
+    left = RunningMoments()
+    left.update(values[:30])
+    right = RunningMoments()
+    right.update(values[30:])
+    merged = left.merge(right).merge(RunningMoments())
+    assert merged.count == 100
+    assert merged.mean == pytest.approx(values.mean())
+    assert merged.std == pytest.approx(values.std(ddof=1))
+    assert (merged.min, merged.max) == (0.0, 99.0)
+
+
+def test_quantile_sketch_merge():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=100000)
+    sketches = []
+    for chunk in np.array_split(values, 8):
+        sketch = QuantileSketch(k=200, seed=0)
+        sketch.update(chunk)
+        sketches.append(sketch)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    assert merged.count == 100000
+    rank = (values < merged.quantile(0.5)).mean()
+    assert abs(rank - 0.5) < 0.02
+    with pytest.raises(ValueError):
+        merged.merge(QuantileSketch(k=100))
+
+
+def test_frequent_items_sketch_merge():
+    left = FrequentItemsSketch()
+    left.update(pd.Series(["a", "b", "b"]))
+    right = FrequentItemsSketch()
+    right.update(pd.Series(["c", "a", "a"]))
+    merged = left.merge(right)
+    assert merged.count == 6
+    assert merged.most_common().to_dict() == {"a": 3, "b": 2, "c": 1}
+    with pytest.raises(ValueError):
+        merged.merge(FrequentItemsSketch(capacity=10))
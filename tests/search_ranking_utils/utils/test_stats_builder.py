@@ -0,0 +1,65 @@
+import pytest
+import pandas as pd
+from search_ranking_utils.utils.schema import Schema
+from search_ranking_utils.utils.testing import assert_dicts_equal
+from search_ranking_utils.utils.stats_builder import (
+    set_stats_from_chunks,
+    set_stats_from_files,
+)
+
+
+@pytest.fixture
+def streamed_schema(dummy_schema_dict, dummy_csv_path) -> Schema:
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    set_stats_from_chunks(schema, pd.read_csv(dummy_csv_path, chunksize=2))
+    return schema
+
+
+def test_set_stats_from_chunks(streamed_schema, dummy_schema):
+    assert_dicts_equal(dummy_schema.imputations, streamed_schema.imputations)
+    assert_dicts_equal(dummy_schema.vocabs, streamed_schema.vocabs)
+    for f, f_stats in dummy_schema.norm_stats.items():
+        assert streamed_schema.norm_stats[f]["mean"] == pytest.approx(
+            f_stats["mean"]
+        )
+        assert streamed_schema.norm_stats[f]["std"] == pytest.approx(
+            f_stats["std"]
+        )
+
+
+@pytest.mark.parametrize(
+    argnames=["impute_type", "expected"],
+    argvalues=[("median", 2.5), ("min", 1.0), ("max", 10.0), ("mode", 1.0)],
+)
+def test_set_stats_from_chunks_numerical_imputations(impute_type, expected):
+    schema = Schema.create_instance_from_dict(
+        {
+            "features": {
+                "numerical": {"x": {"impute": {"impute_type": impute_type}}}
+            },
+            "target": "y",
+            "query_col": "q",
+        }
+    )
+    df = pd.DataFrame({"x": [1.0, None, 1.0, 4.0, 10.0, 2.0, 3.0]})
+    set_stats_from_chunks(schema, [df.iloc[:3], df.iloc[3:]])
+    assert schema.imputations["x"] == expected
+
+
+@pytest.mark.parametrize(argnames="n_jobs", argvalues=[1, 2, -1])
+def test_set_stats_from_files(
+    dummy_schema_dict, dummy_df, dummy_schema, tmp_path, n_jobs
+):
+    # Split the data into a shard per query
+    paths = []
+    for query_id, query_df in dummy_df.groupby("query_id"):
+        path = str(tmp_path / f"{query_id}.csv")
+        query_df.to_csv(path, index=False)
+        paths.append(path)
+    schema = Schema.create_instance_from_dict(dummy_schema_dict)
+    builder = set_stats_from_files(schema, paths, n_jobs=n_jobs, chunksize=2)
+    assert builder.num_rows == len(dummy_df)
+    assert_dicts_equal(dummy_schema.imputations, schema.imputations)
+    assert_dicts_equal(dummy_schema.vocabs, schema.vocabs)
+    for f, f_stats in dummy_schema.norm_stats.items():
+        assert schema.norm_stats[f]["std"] == pytest.approx(f_stats["std"])